@@ -0,0 +1,282 @@
+"""benchmarks for pyimp, run with `python bench.py` (see `python bench.py --help`).
+
+every stage of the partitioning pipeline is timed on the bundled images and on synthetic scans of each size,
+recording wall time, peak RSS and partitions per second. with --save the results become the stored baseline,
+otherwise they are compared against it and the run fails if any stage regressed beyond --threshold.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+import numpy as np
+from PIL import Image
+from pyimp import pyimp
+
+DIR      = os.path.dirname(os.path.realpath(__file__))
+BASELINE = os.path.join(DIR, "bench_baseline.json")
+
+
+def synthIm(size, radius=None, seed=0):
+    """return synthetic RGBA "anomaly only view" image of size by size pixels with a single disc shaped anomaly.
+    """
+    rng    = np.random.default_rng(seed)
+    radius = radius if radius else size // 8
+    rows, cols = np.ogrid[:size, :size]
+    disc   = (rows - size // 2)**2 + (cols - size // 2)**2 <= radius**2
+    npim   = np.zeros((size, size, 4), dtype=np.uint8)
+    npim[disc, :3] = rng.integers(6, 256, size=(disc.sum(), 3))
+    npim[:, :, 3]  = 255
+    return npim
+
+
+def legacyTrace(npim, minpixel=5):
+    """return reference mask using the per pixel loop and 8-neighbour flood fill that buildReference() used
+    before traceReference(). the fill uses an explicit stack so large anomalies can be timed at all.
+    """
+    npim  = npim[:, :, :3]
+    zeros = np.zeros((len(npim), len(npim[0])))
+    moves = [(1,1), (-1,-1), (1,-1), (-1,1), (1,0), (0,1), (-1,0), (0,-1)]
+    for i in range(len(npim)):
+        for j in range(len(npim[i])):
+            stack = [(i, j)]
+            while stack:
+                row, col = stack.pop()
+                if row > len(npim)-1 or col > len(npim[0])-1 or row < 0 or col < 0: continue
+                if zeros[row][col]==1 or not np.all(npim[row][col] > minpixel): continue
+                zeros[row][col] = 1
+                stack.extend((row+m[0], col+m[1]) for m in moves)
+    return zeros
+
+
+def timeit(func, *args, repeat=3):
+    """return best wall time in seconds of repeat calls to func(*args).
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best  = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchReference(sizes=(200, 750)):
+    """print legacy versus traceReference() wall time and speedup per image size.
+    """
+    print("%-8s %-12s %-12s %-8s" % ("size", "legacy (s)", "vector (s)", "speedup"))
+    for size in sizes:
+        npim = synthIm(size)
+        assert np.array_equal(legacyTrace(npim), pyimp.traceReference(npim))
+        legacy = timeit(legacyTrace, npim, repeat=1)
+        vector = timeit(pyimp.traceReference, npim)
+        print("%-8d %-12.4f %-12.6f %-8.0f" % (size, legacy, vector, legacy / vector))
+
+
+def synthScans(directory, size, tags=2, views=2, seed=0):
+    """write synthetic scans of size by size pixels to directory, named as the bundled images are: per tag an
+    anomaly only view (see synthIm()) and views full views of noise with a black margin and the anomaly pasted in.
+    """
+    rng  = np.random.default_rng(seed)
+    name = "absorption_Apples_Anomaly1A20Q_P%02d_GravityJitterOn_%sview_%d_200_high.png"
+    for tag in range(1, tags + 1):
+        anom = synthIm(size, seed=seed + tag)
+        Image.fromarray(anom).save(os.path.join(directory, name % (tag, "anomaly_only_", 0)))
+        for view in range(views):
+            full = rng.integers(0, 256, size=(size, size, 4), dtype=np.uint8)
+            full[:, :size // 4, :3] = 0
+            full[anom[:, :, 0] > 0] = anom[anom[:, :, 0] > 0]
+            Image.fromarray(full).save(os.path.join(directory, name % (tag, "", view)))
+    return directory
+
+
+def resetPeak():
+    """reset the peak RSS of this process (linux only; elsewhere the peak is the process lifetime's).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peakRSS():
+    """return peak RSS of this process in MiB since the last resetPeak().
+    """
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmHWM")) / 1024
+    except (OSError, StopIteration):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(func, repeat=3):
+    """return dictionary of best wall time, peak RSS and partitions (the count func returns, if any) per second
+    of repeat calls to func(), each starting from an empty image cache.
+
+    NOTE  peak RSS is the whole process's, so it includes memory still held from earlier stages.
+    """
+    seconds, rss = float("inf"), 0.0
+    for _ in range(repeat):
+        pyimp.imcache.clear()
+        resetPeak()
+        start   = time.perf_counter()
+        count   = func()
+        seconds = min(seconds, time.perf_counter() - start)
+        rss     = max(rss, peakRSS())
+    return {"seconds": seconds, "peak_rss_mb": rss, "partitions": count,
+            "partitions_per_s": count / seconds if count else None}
+
+
+def benchStages(path, ims, repeat=3, dim=64):
+    """return dictionary of measure() results per stage of partitioning the images ims at path.
+    """
+    ims     = ims.reset_index(drop=True)
+    names   = ims[0].tolist()
+    scans   = [im for im in names if pyimp.getTag(im) and "anomaly_only_view" not in im]
+    refim   = pyimp.getRefIm(ims)
+    ref     = pyimp.buildReference(path, ims)
+    splices = pyimp.createSplices(path, refim, dim=dim)
+    windows = pyimp.createSplices(path, refim, mode='sliding', dim=dim, stride=dim // 2)  # 4 times the windows
+    parts   = [p for ps in pyimp.imPartition(path, ims, ref, splices) if ps for p in ps]
+
+    def legacy():
+        kept = 0
+        for im in scans:
+            npim = pyimp.toNP(path, im)
+            for rsplice, csplice in splices:
+                if pyimp.checkPart(npim, rsplice, csplice, 0.8, 5):
+                    pyimp.labelPart(im, npim, ref[pyimp.getTag(im)], rsplice, csplice, 0.1)
+                    kept += 1
+        return kept
+
+    def save():
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "anom")), os.makedirs(os.path.join(tmp, "noanom"))
+            pyimp.saveParts([parts], os.path.join(tmp, "anom"), os.path.join(tmp, "noanom"))
+        return len(parts)
+
+    def dataset():
+        with tempfile.TemporaryDirectory() as tmp:
+            with pyimp.PartitionWriter(tmp) as writer:
+                writer.extend(parts)
+            _, partitions = pyimp.loadPartitions(tmp)
+            data = max(partitions.values(), key=lambda p : len(p[1]))[0]
+            pyimp.buildFeatureMatrix(data)
+            del data, partitions
+        return len(parts)
+
+    stages = {"decode":                lambda : [pyimp.toNP(path, im) for im in names] and None,
+              "buildReference":        lambda : pyimp.buildReference(path, ims) and None,
+              "createSplices/square":  lambda : pyimp.createSplices(path, refim, dim=dim) and None,
+              "createSplices/variable":lambda : pyimp.createSplices(path, refim, mode='variable', dim=dim, k=4)
+                                                and None,
+              "part":                  lambda : sum(len(ps) for ps in pyimp.imPartition(path, ims, ref, splices)
+                                                    if ps),
+              "part/sliding":          lambda : sum(len(ps) for ps in pyimp.imPartition(path, ims, ref, windows)
+                                                    if ps),
+              "checkPart+labelPart":   legacy,
+              "dedup":                 lambda : pyimp.dedupParts([parts]) and len(parts),
+              "saveParts":             save,
+              "dataset":               dataset}
+    return {stage : measure(func, repeat) for stage, func in stages.items()}
+
+
+def startup(command, repeat=5):
+    """return dictionary of best wall time, as measure() returns, of running command in a new process, i.e. its
+    cold startup.
+
+    NOTE  peak RSS is not recorded: a child's ru_maxrss includes that of this process at the time it was spawned.
+    """
+    seconds = float("inf")
+    for _ in range(repeat):
+        start   = time.perf_counter()
+        subprocess.run(command, cwd=DIR, stdout=subprocess.DEVNULL, check=True)
+        seconds = min(seconds, time.perf_counter() - start)
+    return {"seconds": seconds, "peak_rss_mb": None, "partitions": None, "partitions_per_s": None}
+
+
+def benchStartup(repeat=5):
+    """return dictionary of startup() results for the bare interpreter, importing pyimp and the command line.
+    """
+    commands = {"python":           [sys.executable, "-c", "pass"],
+                "import pyimp":     [sys.executable, "-c", "from pyimp import pyimp"],
+                "--help":           [sys.executable, "-m", "pyimp", "--help"],
+                "partition --help": [sys.executable, "-m", "pyimp", "partition", "--help"]}
+    return {name : startup(command, repeat) for name, command in commands.items()}
+
+
+def benchSuite(sizes=(200, 750, 2000), images=True, subtype="Apples", repeat=3):
+    """return dictionary of the cold startup of pyimp and benchStages() results per dataset: the bundled images of
+    subtype (if images) and synthetic scans of each size, which are split into 50 pixel squares since 64 does not divide them.
+    """
+    results = {"startup": benchStartup()}
+    if images:
+        path = os.path.join(DIR, "images")
+        results["images/" + subtype] = benchStages(path, pyimp.subsetIms(pyimp.getIms(path), subtype), repeat)
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            results["synthetic/%d" % size] = benchStages(synthScans(tmp, size), pyimp.getIms(tmp), repeat, dim=50)
+    return results
+
+
+def compare(results, baseline, threshold=0.5, slack={"seconds": 0.05, "peak_rss_mb": 16}):
+    """return list of strings describing every stage in both results and baseline whose wall time or peak RSS
+    grew by more than threshold (a fraction, e.g. 0.5 for 50%) over its baseline, plus slack per metric so that
+    noise on stages that take milliseconds is not reported.
+    """
+    regressions = []
+    for dataset, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline.get(dataset, {}).get(stage)
+            if base is None: continue
+            for metric in ["seconds", "peak_rss_mb"]:
+                if result[metric] is None or base[metric] is None: continue
+                if result[metric] > base[metric] * (1 + threshold) + slack[metric]:
+                    regressions.append("%s %s %s: %.4g vs baseline %.4g" % (dataset, stage, metric, result[metric],
+                                                                           base[metric]))
+    return regressions
+
+
+def printResults(results):
+    print("%-20s %-24s %-12s %-12s %-12s" % ("dataset", "stage", "seconds", "peak rss mb", "partitions/s"))
+    for dataset, stages in results.items():
+        for stage, result in stages.items():
+            rate = "%-12.0f" % result["partitions_per_s"] if result["partitions_per_s"] else "%-12s" % "-"
+            rss  = "%-12.1f" % result["peak_rss_mb"] if result["peak_rss_mb"] else "%-12s" % "-"
+            print("%-20s %-24s %-12.4f %s %s" % (dataset, stage, result["seconds"], rss, rate))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark the pyimp partitioning pipeline")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[200, 750, 2000], help="synthetic scan sizes")
+    parser.add_argument("--no-images", action="store_true", help="skip the bundled images")
+    parser.add_argument("--subtype", default="Apples", help="subtype of the bundled images to use")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage; the fastest is kept")
+    parser.add_argument("--baseline", default=BASELINE, help="json file of stored results")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.5, help="allowed fractional regression")
+    parser.add_argument("--reference", action="store_true", help="benchmark traceReference() against the legacy "
+                                                                 "flood fill instead")
+    args = parser.parse_args(argv)
+    if args.reference: return benchReference()
+
+    results = benchSuite(args.sizes, not args.no_images, args.subtype, args.repeat)
+    printResults(results)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        return
+    if not os.path.exists(args.baseline):
+        print("no baseline at %s; store one with --save" % args.baseline)
+        return
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    for regression in regressions: print("REGRESSION", regression)
+    if regressions: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
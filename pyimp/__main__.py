@@ -1,110 +1,307 @@
-"""run pyImp from here
+"""run pyImp from here, one stage at a time or (with no command) partition, build-dataset and train in turn, e.g.
+
+    python -m pyimp partition --subtype Tires --mode variable
+    python -m pyimp train --method search --reduce pca
+    python -m pyimp score images/newscans/
+    python -m pyimp --config run.json
+
+every flag can also be set in a json config file by its name, e.g. {"subtype": "Tires", "dim": 32, "no-pngs":
+true}, and unknown names are rejected; flags given on the command line win over the config file.
 """
 import os
-import numpy as np
-import pandas as pd
-from PIL import Image
-from sklearn import svm
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import classification_report, confusion_matrix
-from sklearn.model_selection import GridSearchCV
-from sklearn.metrics import accuracy_score
+import sys
+import json
+import argparse
 
-import pyimp
+DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
-if __name__ == "__main__":
+# NOTE  heavy modules (numpy, pandas, sklearn and pyimp itself) are imported inside the commands that need them,
+#       so that --help and a partition only run start quickly
+
+
+def load():
+    """return the pyimp module, imported on first use.
+    """
+    if __package__:
+        from . import pyimp
+    else:
+        import pyimp
+    return pyimp
+
+
+def paths(args):
+    """return dictionary of the directories every stage reads and writes, given the parsed arguments.
+    """
+    work = args.workdir if args.workdir else os.path.join(args.path, 'partitioned', args.mode)
+    return {'catalog':    os.path.join(args.path, 'partitioned', 'catalog.json'),
+            'references': os.path.join(args.path, 'partitioned', 'references'),
+            'anom':       os.path.join(work, 'anom', args.subtype),
+            'noanom':     os.path.join(work, 'noanom', args.subtype),
+            'dataset':    os.path.join(work, 'dataset', args.subtype),
+            'matrix':     os.path.join(work, 'matrix', args.subtype),
+            'model':      os.path.join(work, 'model', args.subtype),
+            'report':     args.metrics if args.metrics else os.path.join(work, 'run.json')}
+
+
+def catalog(pyimp, args):
+    """return catalog of the images, subset to the subtype if any.
+    """
+    os.makedirs(os.path.dirname(paths(args)['catalog']), exist_ok=True)
+    imdf = pyimp.getCatalog(args.path, paths(args)['catalog'])
+    return pyimp.subsetIms(imdf, args.subtype) if args.subtype else imdf
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Prepare images                                    #
+#                                                   #
+#                                                   #
+#####################################################
+
+def partition(args):
+    """partition the images into the partition dataset, and into pngs unless --no-pngs.
+    """
+    # the dataset is updated incrementally: only new or changed scans (or all of them, if the references,
+    # splices or thresholds changed) are partitioned, and partitions of deleted scans are dropped
+    pyimp     = load()
+    where     = paths(args)
+    imdf      = catalog(pyimp, args)
+    print(imdf.head())
+    reference = pyimp.buildReference(args.path, imdf, store=where['references'])
+    refim     = pyimp.getRefIm(imdf)
+    splices   = pyimp.createSplices(args.path, refim, mode=args.mode, dim=args.dim, k=args.k,
+                                    stride=args.stride)
+    # pngs of scans that are rebuilt or removed are deleted (with --no-pngs too, so none are left stale) and
+    # scans that cannot be partitioned, e.g. corrupt pngs, are skipped with a warning and retried next run
+    thresh    = dict(blackthresh=args.blackthresh, bminpixel=args.bminpixel, anomthresh=args.anomthresh,
+                     banded=args.banded, workers=args.workers or None,
+                     ondrop=lambda names : pyimp.dropParts(names, where['anom'], where['noanom']))
+    if not args.pngs:
+        print(pyimp.updatePartitions(args.path, imdf, reference, splices, where['dataset'], **thresh))
+    else:
+        os.makedirs(where['anom'], exist_ok=True), os.makedirs(where['noanom'], exist_ok=True)
+        with pyimp.PngWriter() as pngs:
+            print(pyimp.updatePartitions(args.path, imdf, reference, splices, where['dataset'], **thresh,
+                                         onparts=lambda p : pyimp.writeParts(p, where['anom'], where['noanom'], pngs)))
+
+    # kept for train, which saves them with the model so that score cuts new scans the same way
+    with open(os.path.join(where['dataset'], 'splices.json'), 'w') as f:
+        json.dump(None if callable(splices) else [[list(r), list(c)] for r, c in splices], f)
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Build dataset                                     #
+#                                                   #
+#                                                   #
+#####################################################
+
+def buildDataset(args):
+    """balance the partition dataset (less near duplicates, with --dedup) and write its feature matrix and labels.
+    """
+    import numpy as np
+    pyimp = load()
+    where = paths(args)
+    names, partitions = pyimp.loadPartitions(where['dataset'])                      # memory mapped
+    geometry = max(partitions, key=lambda g : len(partitions[g][1]))                # one partition shape per matrix
+    data, labels, sources = partitions[geometry]
+    imdf = catalog(pyimp, args)
+
+    keep = np.arange(len(labels))
+    if args.dedup is not None:                                                      # near duplicate partitions
+        keep, _, report = pyimp.dedupIndices(pyimp.partHashes(data), args.dedup, labels,
+                                             pyimp.sourceColumn(names, sources, imdf, 'cargo'))
+        for cargo, counts in report.items():
+            print("%-16s %8d partitions %8d kept %8d duplicates" % (cargo or "unknown", counts["partitions"],
+                                                                     counts["kept"], counts["duplicates"]))
+    index = keep[pyimp.balanceIndices(labels[keep], ratio=args.ratio, seed=args.seed,  # 80:20 distribution per tag
+                                      strata=pyimp.sourceColumn(names, sources, imdf, 'tag')[keep])]
+    os.makedirs(where['matrix'], exist_ok=True)
+    pyimp.buildFeatureMatrix(data, out=os.path.join(where['matrix'], 'X.npy'), index=index)  # normalize, flatten
+    np.save(os.path.join(where['matrix'], 'y.npy'), labels[index])
+    with open(os.path.join(where['matrix'], 'geometry.json'), 'w') as f:
+        json.dump([int(n) for n in geometry.split('x')], f)
+    print("%d partitions of %s, %d anomalous" % (len(index), geometry, int(labels[index].sum())))
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Support Vector Machine                            #
+#                                                   #
+#                                                   #
+#####################################################
 
-    # NOTE  update below as variables to control behavior
-    SUBTYPE     = 'Apples'      # which subtype of images to grab, if any
-    MODE        = 'feature'     # either 'default' or 'feature'
-
-    DIR         = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-    PATH        = os.path.join(DIR, 'images')
-    ANOMPATH    = os.path.join(PATH, 'partitioned', MODE, 'anom', SUBTYPE)
-    NOANOMPATH  = os.path.join(PATH, 'partitioned', MODE, 'noanom', SUBTYPE)
-    ANOMFILE    = os.path.join(ANOMPATH, str(SUBTYPE + str(1) + ".npy"))
-    NOANOMFILE  = os.path.join(NOANOMPATH, str(SUBTYPE + str(0) + ".npy"))
-
-
-    #####################################################
-    #                                                   #
-    #                                                   #
-    # Prepare images                                    #
-    #                                                   #
-    #                                                   #
-    #####################################################
-
-    if not os.path.exists(NOANOMFILE) and not os.path.exists(ANOMFILE):
-        imdf      = pyimp.getIms(PATH)
-        print(imdf.head())
-        imdf      = pyimp.subsetIms(imdf, SUBTYPE)
-        reference = pyimp.buildReference(PATH, imdf)
-        refim     = pyimp.getRefIm(imdf)
-        splices   = pyimp.createSplices(PATH, refim, mode='feature', dim=64, k=4)
-        partimgs  = pyimp.imPartition(PATH, imdf, reference, splices)
-
-        # NOTE: refactor below to be cleaner.
-        part0, part1 = [], []
-        parts = []
-        for p in partimgs:
-            if isinstance(p, list):
-                parts.append(p)
-                for i in range(len(p)):
-                    if p[i][2]==0:
-                        part0.append((p[i][1], p[i][2]))
-                    elif p[i][2]==1:
-                        part1.append((p[i][1], p[i][2]))
-        np.save(NOANOMFILE, part0, allow_pickle=True)
-        np.save(ANOMFILE, part1, allow_pickle=True)
-        pyimp.saveParts(parts, ANOMPATH, NOANOMPATH)
-
-
-    #####################################################
-    #                                                   #
-    #                                                   #
-    # Build dataset                                     #
-    #                                                   #
-    #                                                   #
-    #####################################################
-
-    part0 = np.load(NOANOMFILE, allow_pickle=True)
-    part1 = np.load(ANOMFILE, allow_pickle=True)
-
-    part0, part1 = pyimp.underSamp(part0, part1)                                    # 80:20 distribution, by default
-    xfunc = lambda x : (np.asarray(x[0], dtype="float") /                           # normalize and flatten
-                        np.linalg.norm(np.asarray(x[0], dtype="float"))).flatten()
-    yfunc = lambda x : np.asarray(x[1])
-    X = np.concatenate((
-                np.asarray(list(map(xfunc, part0))),
-                np.asarray(list(map(xfunc, part1)))), axis=0)
-    y = np.concatenate((
-                np.asarray(list(map(yfunc, part0))),
-                np.asarray(list(map(yfunc, part1)))), axis=0)
-
-    Xtrain, Xtest, ytrain, ytest = train_test_split(X, y, test_size=0.3, random_state=42)
-
-    #####################################################
-    #                                                   #
-    #                                                   #
-    # Support Vector Machine                            #
-    #                                                   #
-    #                                                   #
-    #####################################################
-
-    clf  = svm.SVC(kernel='linear')
-    ypred = clf.fit(Xtrain, ytrain).predict(Xtest)
+def train(args):
+    """fit a linear svm, or search svm.SVC configurations, on the feature matrix and save the model.
+    """
+    import numpy as np
+    from sklearn.model_selection import train_test_split
+    from sklearn.metrics import classification_report, confusion_matrix, accuracy_score
+    pyimp = load()
+    where = paths(args)
+    X     = np.load(os.path.join(where['matrix'], 'X.npy'), mmap_mode='r')
+    y     = np.load(os.path.join(where['matrix'], 'y.npy'))
+    Xtrain, Xtest, ytrain, ytest = train_test_split(X, y, test_size=args.test_size, random_state=args.seed)
+
+    if args.method == 'search':
+        clf = pyimp.searchSVM(Xtrain, ytrain, pyimp.svmGrid(), halving=args.halving,  # degree only for poly
+                              workers=args.workers, reduce=args.reduce, components=args.components,
+                              seed=args.seed)
+        print(clf.best_params_)
+        print(pyimp.searchReport(clf).to_string(index=False))                     # timing per configuration
+        clf = clf.best_estimator_
+    else:
+        clf = pyimp.trainLinear(Xtrain, ytrain, method=args.method, seed=args.seed)  # not SVC(kernel='linear')
+    ypred = clf.predict(Xtest)
     print(classification_report(ytest, ypred))
     print(confusion_matrix(ytest, ypred))
     print(accuracy_score(ytest, ypred))
 
+    # kept with its splices for scoring new scans with the score command
+    with open(os.path.join(where['dataset'], 'splices.json')) as f:
+        splices = json.load(f)
+    with open(os.path.join(where['matrix'], 'geometry.json')) as f:
+        geometry = json.load(f)
+    if splices is None:
+        print("not saving the model: adaptive splices differ per scan, so score cannot cut new scans the same way")
+        return
+    pyimp.saveModel(clf, where['model'], splices, geometry, args.blackthresh, args.bminpixel)
+    print("saved model to %s" % where['model'])
+
+
+def score(args):
+    """score new scans with the saved model (see score.py).
+    """
+    if __package__:
+        from . import score as scoring
+    else:
+        import score as scoring
+    args.model = args.model if args.model else paths(args)['model']
+    scoring.run(args, load())
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Command line                                      #
+#                                                   #
+#                                                   #
+#####################################################
+
+# flags every command takes, before or after the command's name
+COMMON = [('--path',        dict(default=os.path.join(DIR, 'images'), help="directory of the images")),
+          ('--subtype',     dict(default='Apples', help="which subtype of images to grab, if any")),
+          ('--mode',        dict(default='feature', help="splice mode of createSplices(), which also names the "
+                                                         "output directory")),
+          ('--workdir',     dict(help="output directory, with default of PATH/partitioned/MODE")),
+          ('--dim',         dict(type=int, default=64)),
+          ('--k',           dict(type=int, default=4)),
+          ('--stride',      dict(type=int, help="pixels between windows of --mode sliding, with default of DIM/2")),
+          ('--blackthresh', dict(type=float, default=0.80)),
+          ('--bminpixel',   dict(type=int, default=5)),
+          ('--anomthresh',  dict(type=float, default=0.10)),
+          ('--seed',        dict(type=int, default=42)),
+          ('--metrics',     dict(help="json run report, with default of WORKDIR/run.json")),
+          ('--profile',     dict(nargs='*', default=[], help="stages to profile, e.g. part train"))]
+
+
+def parser():
+    """return 2-tuple of (argparse parser, dictionary of its command parsers by name).
+    """
+    if __package__:
+        from . import score as scoring
+    else:
+        import score as scoring
+    main = argparse.ArgumentParser(prog="pyimp", description=__doc__.split("\n\n")[0],
+                                   epilog=__doc__.split("\n\n", 1)[1], formatter_class=argparse.RawTextHelpFormatter)
+    main.add_argument('--config', help="json file of flag values, by flag name")
+    for flag, kwargs in COMMON: main.add_argument(flag, **kwargs)
+    subparsers = main.add_subparsers(dest='command')
+    commands   = {}
+    for name, func in [('partition', partition), ('build-dataset', buildDataset), ('train', train),
+                       ('score', score)]:
+        commands[name] = subparsers.add_parser(name, help=func.__doc__.strip())
+        # suppressed, so a command's defaults do not replace flags given before the command's name
+        for flag, kwargs in COMMON: commands[name].add_argument(flag, **{**kwargs, 'default': argparse.SUPPRESS})
+
+    commands['partition'].add_argument('--no-pngs', dest='pngs', action='store_false',
+                                       help="only write the partition dataset")
+    commands['partition'].add_argument('--banded', action='store_true',
+                                       help="decode each scan band by band, bounding memory by the splice height")
+    commands['partition'].add_argument('--workers', type=int, default=1,
+                                       help="processes that partition new or changed scans, 0 for every core")
+    commands['build-dataset'].add_argument('--ratio', type=int, nargs=2, default=[4, 1],
+                                           help="nonanomalous to anomalous ratio")
+    commands['build-dataset'].add_argument('--dedup', type=int, metavar='DISTANCE',
+                                           help="drop partitions whose hash is within DISTANCE bits of one kept")
+    commands['train'].add_argument('--method', default='linearsvc', choices=['linearsvc', 'sgd', 'search'])
+    commands['train'].add_argument('--no-halving', dest='halving', action='store_false',
+                                   help="search every candidate on every sample")
+    commands['train'].add_argument('--reduce', choices=['pca', 'random'], help="dimension reduction before the svm")
+    commands['train'].add_argument('--components', type=int, default=256)
+    commands['train'].add_argument('--workers', type=int, default=-1)
+    commands['train'].add_argument('--test-size', type=float, default=0.3)
+    scoring.arguments(commands['score'], optional=True)
+    return main, commands
+
+
+def flags(parser):
+    """return dictionary of the parser's actions by flag name without dashes (e.g., 'no-pngs'), or by name for
+    positional arguments.
+    """
+    actions = {}
+    for action in parser._actions:
+        if isinstance(action, argparse._HelpAction): continue
+        for name in action.option_strings if action.option_strings else [action.dest]:
+            if name.startswith('--') or not action.option_strings: actions[name.lstrip('-')] = action
+    return actions
+
+
+def configValue(action, value):
+    """return the value of action's destination for a config file value: switches such as --no-pngs take true
+    (given) or false (not given) rather than the value of the destination.
+    """
+    if action.nargs == 0 and action.const is not None:
+        return action.const if value else action.default
+    return value
+
+
+def parse(argv=None):
+    """return parsed arguments with defaults from the --config file, if any. with no command, the flags of
+    partition, build-dataset and train are all set so that each stage can run.
+    """
+    main, commands = parser()
+    args = main.parse_args(argv)
+    if args.config:
+        with open(args.config) as f:
+            config = {name.replace('_', '-') : value for name, value in json.load(f).items()}
+        common  = {name.lstrip('-') for name, _ in COMMON}
+        unknown = [name for name in config if name not in common and
+                   not any(flags(command).get(name) for command in commands.values())]
+        if unknown: main.error("unknown flag(s) in %s: %s" % (args.config, ", ".join(sorted(unknown))))
+        main.set_defaults(**{flags(main)[name].dest : value for name, value in config.items() if name in common})
+        for command in commands.values():
+            actions = flags(command)
+            command.set_defaults(**{actions[name].dest : configValue(actions[name], value)
+                                    for name, value in config.items() if name not in common and name in actions})
+        args = main.parse_args(argv)
+    for name in ['partition', 'build-dataset', 'train'] if args.command is None else []:
+        for flag, value in vars(commands[name].parse_args([])).items():
+            if not hasattr(args, flag): setattr(args, flag, value)
+    return args
+
+
+if __name__ == "__main__":
+    args    = parse()
+    pyimp   = load()
+    metrics = pyimp.metrics or pyimp.configureMetrics(args.profile)  # PYIMP_METRICS may have set it already
+    stages  = {'partition': [partition], 'build-dataset': [buildDataset], 'train': [train], 'score': [score],
+               None: [partition, buildDataset, train]}
+    for stage in stages[args.command]: stage(args)
 
-    grid = {'C':[0.1,1,100,1000],
-            'kernel':['rbf','poly', 'linear'],
-            'degree':[4,5,6],
-            'gamma': [1, 0.1, 0.01]}
-    grid = GridSearchCV(svm.SVC(), grid, refit = True)
-    grid.fit(Xtrain, ytrain)
-    print(classification_report(ytest, grid.best_estimator_.predict(Xtest)))
-    print(confusion_matrix(ytest, grid.best_estimator_.predict(Xtest)))
-    print(grid.score(Xtest, ytest))
-    print(grid.best_params_)
+    # seconds per stage, partitions kept/rejected and labels counted, and any profiles
+    os.makedirs(os.path.dirname(paths(args)['report']), exist_ok=True)
+    print(json.dumps(metrics.save(paths(args)['report'])["stages"], indent=2), file=sys.stderr)
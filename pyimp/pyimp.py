@@ -1,14 +1,150 @@
 import os
 import re
-import cv2
-import sys
-sys.setrecursionlimit(10000)
-import random
-import pandas as pd
+import json
+import hashlib
+import struct
+import tempfile
+import zlib
+import time
+import functools
+import threading
+import warnings
+import contextlib
+import multiprocessing
 import numpy as np
 from typing import List
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
-from matplotlib import pyplot as plt
+
+# NOTE  pandas, matplotlib and sklearn are imported inside the methods that use them, so that importing pyimp
+#       (e.g., for a partition only run or --help) only pays for numpy and Pillow
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Metrics                                           #
+#                                                   #
+#                                                   #
+#####################################################
+
+class Metrics:
+    """timers and counters per stage of a run, filled in by the methods decorated with instrument() while this
+    is the shared metrics (see configureMetrics()).
+
+    :param profile: list of stage names, with default of (), whose calls are also profiled with cProfile.
+
+    NOTE  stages nest (e.g., part decodes with toNP), so the seconds of a stage include those of the stages it
+          calls, and a stage called inside a profiled stage is profiled as part of it. timers and counters of
+          worker processes of imPartition() are merged in when the workers return; their stages are not profiled.
+    """
+
+    def __init__(self, profile=()):
+        self.profile    = set(profile)
+        self.timers     = {}  # stage -> [calls, seconds]
+        self.counters   = {}
+        self.profiles   = {}  # stage -> cProfile.Profile
+        self._profiling = None
+        self._lock      = threading.Lock()
+        self._start     = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """context manager timing (and, if name is in profile, profiling) its body as one call of stage name.
+        """
+        profiler = None
+        if name in self.profile and self._profiling is None:  # only one profiler can be active at a time
+            import cProfile
+            profiler = self._profiling = self.profiles.setdefault(name, cProfile.Profile())
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = None
+            self.merge({name: [1, seconds]})
+
+    def count(self, **counts):
+        """add counts, given as keyword arguments, to the counters.
+        """
+        self.merge(counters=counts)
+
+    def merge(self, timers={}, counters={}):
+        """add timers ({stage: [calls, seconds]}) and counters, e.g. from another process, to these.
+        """
+        with self._lock:
+            for name, (calls, seconds) in timers.items():
+                timer     = self.timers.setdefault(name, [0, 0.0])
+                timer[0] += calls
+                timer[1] += seconds
+            for name, n in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self, top=20):
+        """return json serializable dictionary of the run: wall seconds, calls, seconds and mean milliseconds per
+        stage, counters, imcache stats and the top functions by cumulative time per profiled stage.
+        """
+        import pstats
+        profiles = {}
+        for name, profiler in self.profiles.items():
+            stats = sorted(pstats.Stats(profiler).stats.items(), key=lambda item : item[1][3], reverse=True)
+            profiles[name] = [{"function": "%s:%d(%s)" % function, "calls": nc, "tottime": tt, "cumtime": ct}
+                              for function, (cc, nc, tt, ct, callers) in stats[:top]]
+        return {"seconds": time.perf_counter() - self._start,
+                "stages": {name: {"calls": calls, "seconds": seconds, "mean_ms": 1000 * seconds / calls}
+                           for name, (calls, seconds) in self.timers.items()},
+                "counters": dict(self.counters),
+                "imcache": imcache.stats() if imcache is not None else None,
+                "profiles": profiles}
+
+    def save(self, filename, top=20):
+        """write report() to the json file filename, and each stage's profile next to it as
+        <filename without .json>.<stage>.prof for pstats or snakeviz. returns the report.
+        """
+        report = self.report(top)
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2)
+        for name, profiler in self.profiles.items():
+            profiler.dump_stats("%s.%s.prof" % (os.path.splitext(filename)[0], name))
+        return report
+
+
+def instrument(stage):
+    """decorator timing every call of the decorated method as stage on the shared metrics, when set.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if metrics is None: return func(*args, **kwargs)
+            with metrics.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def configureMetrics(profile=()):
+    """replace the shared metrics filled in by instrumented methods and return it.
+
+    NOTE  parameters described in Metrics.
+    """
+    global metrics
+    metrics = Metrics(profile)
+    return metrics
+
+
+# shared metrics; None (the default) records nothing. setting the environment variable PYIMP_METRICS to a json
+# path records every run and saves its report there on exit, profiling the comma separated stages in
+# PYIMP_PROFILE, so production runs can be inspected without editing code
+metrics = None
+if os.environ.get("PYIMP_METRICS") and multiprocessing.parent_process() is None:
+    import atexit
+    configureMetrics([name for name in os.environ.get("PYIMP_PROFILE", "").split(",") if name])
+    atexit.register(lambda : metrics is not None and metrics.save(os.environ["PYIMP_METRICS"]))
 
 
 #####################################################
@@ -19,7 +155,8 @@ from matplotlib import pyplot as plt
 #                                                   #
 #####################################################
 
-def imPartition(path, images, reference, splices, blackthresh=0.80, bminpixel=5, anomthresh=0.10):
+def imPartition(path, images, reference, splices, blackthresh=0.80, bminpixel=5, anomthresh=0.10,
+                workers=1, chunksize=1, banded=False):
     """returns partitioned images together with the path to the original image and a label (0 or 1) for
     whether it is anomalous.
 
@@ -27,7 +164,8 @@ def imPartition(path, images, reference, splices, blackthresh=0.80, bminpixel=5,
     :param images: dataframe with the images.
     :param reference: dictionary of anomaly tags to reference images generated by buildReference().
     :param splices: list of splices according to which to splice the images to. Data has form
-                    [[(rowindex1, rowindex2), (colindex1, colindex2), ...]]
+                    [[(rowindex1, rowindex2), (colindex1, colindex2), ...]], or an AdaptiveSplices from
+                    createSplices(mode='adaptive') to splice each image separately.
     :param blackthresh: float point value between 0 and 1, with default of 0.8, that specifies how pixels
                         need to be black to constitute a black image that is rejected.
     :param bminpixel: integer value, with default of 5, that specifies the ceiling value for what constitutes
@@ -35,35 +173,212 @@ def imPartition(path, images, reference, splices, blackthresh=0.80, bminpixel=5,
     :param anomthresh: float point value between 0 and 1, with default of 0.1, that specifies how much of an
                        image needs to contains anomalous pixels (i.e., is a pixel part of anomaly) to be
                        labeled with a 1.
+    :param workers: integer value, with default of 1, that specifies how many processes partition the images.
+                    None uses every core. each worker decodes and crops its images, and this process only reads
+                    the kept partitions back from a file in shared memory (/dev/shm where available), so scaling
+                    is bounded by that read (a memcpy of the partitions' bytes) rather than by decoding. use
+                    partRecords() and gatherParts() instead when the partitions should not all be held in memory.
+    :param chunksize: integer value, with default of 1, that specifies how many images are sent to a worker
+                      process at a time.
+    :param banded: boolean, with default of False, that specifies whether to decode each image band by band
+                   with partBands(), bounding the memory used per image by the height of the splices.
     :returns: list of tuples as (path, numpy array, label of 0 or 1 for whether anomaly is present)
     """
+    names = [tup[1] for tup in list(images.itertuples())]  # list of image names/paths
+
     # maps the part() method to every image in images. This part() method partitions images by the provided
     # splices and append images with a label (0 or 1 if anomalous) if they contain enough non-background
     # (i.e., are less than 1-blackthresh black).
-    return [*map(lambda x : part(path, x, reference, splices, blackthresh, bminpixel, anomthresh),
-               [tup[1] for tup in list(images.itertuples())])]  # list of image names/paths
+    partImage = partBands if banded else part
+    if workers == 1:
+        return [*map(lambda x : partImage(path, x, reference, splices, blackthresh, bminpixel, anomthresh), names)]
+    # workers decode and crop each image and hand its partitions back in a file in shared memory, so no pixels
+    # are pickled and the image is not decoded again here; the parent only reads each file once
+    return [parts for _, parts in _partShared(path, names, reference, splices, blackthresh, bminpixel, anomthresh,
+                                              workers, chunksize, banded)]
+
+
+# directory the partitions of worker processes are handed back in: memory backed where /dev/shm exists
+SHAREDDIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def _partShared(path, names, reference, splices, bthresh, minbpixel, athresh, workers, chunksize, banded=False,
+                onerror=None):
+    """yields 2-tuples of (image name, part() (or, if banded, partBands()) result) for every image in names, in
+    order, using workers processes that return the partitions through files in a temporary directory in
+    SHAREDDIR. the first image that fails raises its exception, unless onerror is given, in which case it is
+    called with the image name and the exception and the image is skipped.
+
+    NOTE  the directory, and any partitions in it not yet read, are removed however the generator ends.
+    """
+    with tempfile.TemporaryDirectory(prefix="pyimp-", dir=SHAREDDIR) as blocks:
+        args = (path, reference, splices, bthresh, minbpixel, athresh, metrics is not None, banded, blocks)
+        with _pool(workers, args) as pool:
+            chunks  = [names[i:i + chunksize] for i in range(0, len(names), max(chunksize, 1))]
+            futures = [pool.submit(_partWorker, chunk) for chunk in chunks]
+            try:
+                for chunk, future in zip(chunks, futures):
+                    for im, (index, block, timers, counters, error) in zip(chunk, future.result()):
+                        if metrics is not None: metrics.merge(timers, counters)
+                        if error is not None and onerror is None: raise error
+                        if error is not None:
+                            onerror(im, error)
+                            continue
+                        yield im, _fromShared(im, index, block)
+            finally:
+                for future in futures: future.cancel()  # running chunks finish before the directory is removed
+
+
+def _fromShared(im, index, block):
+    """return list of Part()s of im given a list of (splice index, label, shape) 3-tuples and the path of the
+    file _partWorker() wrote their pixels to one after another, which is then deleted.
+    """
+    if block is None: return index
+    data = np.fromfile(block, dtype=np.uint8)
+    os.remove(block)
+    parts, offset = [], 0
+    for splice, label, shape in index:
+        size = int(np.prod(shape))
+        parts.append(Part(im, data[offset:offset + size].reshape(shape), label, splice))  # views of one copy
+        offset += size
+    return parts
+
+
+def _partIndices(path, names, reference, splices, bthresh, minbpixel, athresh, workers, chunksize):
+    """return list of partIndex() results for every image in names, in order, using workers processes.
+    """
+    if workers == 1:
+        return [partIndex(path, im, reference, splices, bthresh, minbpixel, athresh) for im in names]
+    args = (path, reference, splices, bthresh, minbpixel, athresh, metrics is not None)
+    with _pool(workers, args) as pool:
+        results = list(pool.map(_partIndexWorker, names, chunksize=chunksize))  # map keeps the order of the images
+    if metrics is not None:
+        for _, timers, counters in results: metrics.merge(timers, counters)
+    return [index for index, _, _ in results]
 
 
 def part(path, im, ref, splices, bthresh=0.8, minbpixel=5, athresh=0.1):
     """returns labeled (0 - nonanomalous, 1 - anomalous) partitions of the inputted image.
 
+    NOTE  parameters described in imPartition.
+    """
+    index = partIndex(path, im, ref, splices, bthresh, minbpixel, athresh)
+    return None if index is None else fromIndex(path, im, splices, index)
+
+
+@instrument("part")
+def partIndex(path, im, ref, splices, bthresh=0.8, minbpixel=5, athresh=0.1):
+    """returns list of 2-tuples as (index into splices, label of 0 or 1) for the partitions of the inputted image
+    that are kept, or None if the image is not partitioned.
+
     NOTE  parameters described in imPartition.
     """
     # termination condition:
     # the image doesn't return a proper tag or contains only the anomaly
     tag = getTag(im)
-    if not tag or "anomaly_only_view" in im: return
+    if not tag or "anomaly_only_view" in im:
+        if metrics is not None: metrics.count(skipped=1)
+        return
 
     # part input image according to input slices, keeping those partitions that are not too
     # black and labeling them according to whether they are anomalous or not
-    refim = ref[tag]
-    npim  = toNP(path, im)
-    return [labelPart(im, npim, refim, s[0], s[1], athresh)  # s[0] is the row tuple and s[1] is the column tuple
-                      for s in splices
-                      if checkPart(npim, s[0], s[1], bthresh, minbpixel)]
+    # (scored for every splice at once with scoreSplices(), giving the same ratios as checkPart() and labelPart())
+    splices        = imSplices(path, im, splices)
+    bratio, aratio = scoreSplices(toNP(path, im), ref[tag], splices, minbpixel)
+    index          = [(i, 1 if aratio[i] > athresh else 0) for i in np.flatnonzero(bratio < bthresh).tolist()]
+    if metrics is not None:
+        anomalous = sum(label for _, label in index)
+        metrics.count(images=1, kept=len(index), rejected=len(bratio) - len(index), anomalous=anomalous,
+                      nonanomalous=len(index) - anomalous)
+    return index
+
+
+class Part(tuple):
+    """(name of image, numpy array of partition, label) 3-tuple, as part() returns them, that also holds the index
+    of its splice as splice, by which writeParts() names its png.
+    """
+
+    def __new__(cls, im, array, label, splice=None):
+        part = super().__new__(cls, (im, array, label))
+        part.splice = splice
+        return part
+
+    def __getnewargs__(self):
+        return (*self, self.splice)
+
+
+def fromIndex(path, im, splices, index):
+    """returns list of 3-tuples as (name of image, numpy array of partition, label) given the output of partIndex().
+    """
+    npim    = toNP(path, im)
+    splices = imSplices(path, im, splices)
+    return [Part(im, npim[splices[i][0][0]:splices[i][0][1], splices[i][1][0]:splices[i][1][1]][:, :, :3], label, i)
+            for i, label in index]
 
 
-def buildReference(path, ims, minpixel=5):
+# partition record: the image (index into a list of names) a partition is cut from, its row and column spans
+# and its label. records describe partitions without holding any pixels.
+PARTDTYPE = np.dtype([('image', np.int32), ('r0', np.int32), ('r1', np.int32), ('c0', np.int32), ('c1', np.int32),
+                      ('label', np.int8)])
+
+
+def partRecords(path, images, reference, splices, blackthresh=0.80, bminpixel=5, anomthresh=0.10,
+                workers=1, chunksize=1):
+    """returns 2-tuple of (list of image names, structured array of PARTDTYPE records) describing the same
+    partitions as imPartition() without holding their pixels. use partView() or gatherParts() to get them.
+
+    NOTE  parameters described in imPartition.
+    """
+    names   = [tup[1] for tup in list(images.itertuples())]  # list of image names/paths
+    indices = _partIndices(path, names, reference, splices, blackthresh, bminpixel, anomthresh, workers, chunksize)
+    records = []
+    for i, (im, index) in enumerate(zip(names, indices)):
+        if not index: continue
+        imsplices = imSplices(path, im, splices)
+        records  += [(i, *imsplices[j][0], *imsplices[j][1], label) for j, label in index]
+    return names, np.array(records, dtype=PARTDTYPE)
+
+
+def partView(path, names, record):
+    """returns the pixels of the partition described by record as a view (no copy) of its decoded image.
+    """
+    npim = toNP(path, names[record['image']])
+    return npim[record['r0']:record['r1'], record['c0']:record['c1']][:, :, :3]
+
+
+def gatherParts(path, names, records, out=None):
+    """returns uint8 numpy array of shape (len(records), rows, cols, 3) holding the pixels of every partition in
+    records, which must all have the same shape, decoding each image once.
+
+    :param out: numpy array (or memmap), with default of None, to gather into instead of a new array.
+
+    NOTE  partitions cut off by the edge of their image are padded with 0s. select records of one shape with
+          e.g. records[(records['r1'] - records['r0'] == 64) & (records['c1'] - records['c0'] == 64)].
+    """
+    shapes = np.unique(np.stack([records['r1'] - records['r0'], records['c1'] - records['c0']], axis=1), axis=0)
+    if len(shapes) > 1: raise ValueError("records have %d different partition shapes" % len(shapes))
+    rows, cols = shapes[0] if len(shapes) else (0, 0)
+    out = np.empty((len(records), rows, cols, 3), dtype=np.uint8) if out is None else out
+
+    # records are visited grouped by image so that each image is decoded (or fetched from imcache) once
+    # (partitions inside the image are copied out of its windowView() in one indexing operation)
+    order  = np.argsort(records['image'], kind='stable')
+    bounds = np.flatnonzero(np.diff(records['image'][order])) + 1
+    for group in np.split(order, bounds) if len(order) else []:
+        npim   = toNP(path, names[records['image'][group[0]]])
+        inside = (records['r1'][group] <= npim.shape[0]) & (records['c1'][group] <= npim.shape[1])
+        if inside.any():
+            out[group[inside]] = windowView(npim, rows, cols)[records['r0'][group[inside]],
+                                                              records['c0'][group[inside]]]
+        for i in group[~inside].tolist():
+            view = npim[records['r0'][i]:records['r1'][i], records['c0'][i]:records['c1'][i]][:, :, :3]
+            out[i] = 0
+            out[i, :view.shape[0], :view.shape[1]] = view
+    return out
+
+
+@instrument("buildReference")
+def buildReference(path, ims, minpixel=5, workers=1, chunksize=1, store=None):
     """returns dictionary of tag:reference pairs where tag is the "P/d/d" anomaly tag and the reference
        is an array with all 0s except for 1s where an anomaly is present at that pixel
 
@@ -71,79 +386,211 @@ def buildReference(path, ims, minpixel=5):
     :param ims: dataframe with the images.
     :param minpixel: integer value, with default of 5, that specifies the ceiling value for what constitutes
                      a black pixel.
+    :param workers: integer value, with default of 1, that specifies how many processes trace the references.
+                    None uses every core.
+    :param chunksize: integer value, with default of 1, that specifies how many tags are sent to a worker
+                      process at a time.
+    :param store: path to a directory, with default of None, in which references are kept between runs. if
+                  given, a ReferenceStore is returned that loads (or traces) each reference on first use.
     :returns: dictionary where keys are the string anomaly tag and values are numpy arrays with 1s at the pixel
               value where there is anomaly present.
     """
-    # helper: builds reference image that "traces" the anomaly and returns
-    # an array with 1s at pixels where anomaly is
-    def build(reference):
-        zeros = np.zeros((len(reference), len(reference[0])))
-        for i in range(len(reference)):
-            for j in range(len(reference[i])):
-                if np.all(reference[i][j] > minpixel):
-                    BFS(i, j, reference, zeros)
-        return zeros
-
-
-    # helper: identifies which pixels contain anomaly using breadth first search,
-    # looping through every pixel until we find an anomalous one, then considering every
-    # neighbor that is anomalous until none are left / all are visited
-    # assumption: there is only one anomaly in each image
-    def BFS(row, col, reference, zeros):
-        if row > len(reference)-1 or col > len(reference[0])-1 or row <0 or col <0: return
-        if zeros[row][col]==1: return
-
-        pixel = reference[row][col]
-        if np.all(pixel > minpixel):
-            zeros[row][col] = 1
-        else:
-            return
+    # assumption: there exists an "anomaly only view" version of every image that can be "traced" to
+    # identify which pixels are anomalous versus not anomalous using traceReference()
+    # for each tag, in the order the tags first appear, grab the first anomaly only view with that tag
+    views   = anomalyViews(ims)
+    sources = {}
+    for tag in (ims['tag'] if 'tag' in ims.columns else map(getTag, ims[0])):
+        if tag and tag not in sources: sources[tag] = views[tag]
 
-        moves = [(1,1), (-1,-1), (1,-1), (-1,1), (1,0), (0,1), (-1,0), (0,-1)]
-        for m in moves:
-            BFS(row+m[0], col+m[1], reference, zeros)
+    if store:
+        return ReferenceStore(store, path, sources, minpixel)
+    if workers == 1:
+        return {tag : traceReference(toNP(path, reference), minpixel) for tag, reference in sources.items()}
 
+    # tags are independent so each is traced in a worker, which returns the mask packed to 1 bit per pixel
+    with _pool(workers, (path, minpixel)) as pool:
+        packed = list(pool.map(_traceWorker, sources.values(), chunksize=chunksize))
+    return {tag : np.unpackbits(bits, count=shape[0]*shape[1]).reshape(shape).astype(float)
+            for tag, (bits, shape) in zip(sources.keys(), packed)}
 
-    # assumption: there exists an "anomaly only view" version of every image that can be "traced" to
-    # identify which pixels are anomalous versus not anomalous using the above build and BFS methods
-    # for each tag, builds reference image from zeros array by running BFS on the first pixel
-    # that is non black, converting 0s to 1s for all adjacent pixels that are non black
-    references = {}
-    for i in ims.iterrows():
-        imname = i[1][0]
-        tag = getTag(imname) if getTag(imname) else ""
-        if tag and tag not in references.keys():
-            func = lambda x: ("anomaly_only_view" in str(x)) and (tag in str(x))
-
-            # grab the next image (as its name in the df) that is a full image and has the anomaly in
-            # the correct position (i.e., there is a match on the anomaly tag that is part of the name)
-            reference = next(filter(func, [tup[1]  # holds the image name, whereas tup[0] holds the index
-                                           for tup
-                                           in list(ims.itertuples())]))
-            references[tag] = build(toNP(path, reference)[:, :, :3])
-    return references
-
-
-def createSplices(path, im, mode='square', dim=64, k=None):
+
+def traceReference(npim, minpixel=5):
+    """returns array of the image's dimensions with 1s at pixels where the anomaly is and 0s elsewhere.
+
+    :param npim: numpy array of an "anomaly only view" image.
+    :param minpixel: integer value, with default of 5, that specifies the ceiling value for what constitutes
+                     a black pixel.
+    :returns: float numpy array of 0s and 1s with the same number of rows and columns as npim.
+    """
+    # algorithm: a pixel is anomalous if every RGB channel is above minpixel. tracing used to flood fill
+    # from every such pixel, but since every pixel was visited the fill always marked exactly the
+    # thresholded pixels, i.e., the union of all connected components. thresholding the whole array
+    # gives the same mask without the per pixel loop or recursion (which overflowed on large anomalies).
+    return np.all(npim[:, :, :3] > minpixel, axis=2).astype(float)
+
+
+class ReferenceStore(Mapping):
+    """dictionary of tag:reference pairs, as buildReference() returns, whose references are loaded from (or
+    traced and saved to) a directory the first time each is used.
+
+    :param directory: path to the directory the references are kept in.
+    :param path: path to where the images are.
+    :param sources: dictionary of anomaly tag to the name of the anomaly only view traced for it.
+    :param minpixel: integer value, with default of 5, used by traceReference().
+
+    NOTE  references are bool arrays (1 byte per pixel rather than the 8 of buildReference()'s float arrays) and
+          are saved bit packed (1 bit per pixel). a saved reference is retraced if its source image's contents
+          or minpixel changed; the contents are only rehashed if the source's size or modification time did.
+    """
+
+    def __init__(self, directory, path, sources, minpixel=5):
+        os.makedirs(directory, exist_ok=True)
+        self.directory, self.path, self.sources, self.minpixel = directory, path, dict(sources), minpixel
+        self._masks = {}
+
+    def __getitem__(self, tag):
+        if tag not in self._masks:
+            self._masks[tag] = self._load(tag)
+        return self._masks[tag]
+
+    def __contains__(self, tag):
+        return tag in self.sources
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def digest(self, tag):
+        """return hex digest of the reference for tag, without unpacking it if it is already saved.
+        """
+        meta = self._meta(tag)
+        if meta is None:
+            self._masks[tag] = self._load(tag)  # traces and saves it
+            meta = self._meta(tag)
+        return meta["mask"]
+
+    def _file(self, tag):
+        return os.path.join(self.directory, tag + ".npz")
+
+    def _meta(self, tag):
+        """return the saved reference's metadata if it is still valid for its source image; else None.
+        """
+        if not os.path.exists(self._file(tag)): return None
+        with np.load(self._file(tag)) as saved:
+            meta = json.loads(str(saved["meta"]))
+        source = os.path.join(self.path, self.sources[tag])
+        stat   = os.stat(source)
+        if meta["source"] != self.sources[tag] or meta["minpixel"] != self.minpixel: return None
+        if [meta["size"], meta["mtime"]] == [stat.st_size, stat.st_mtime_ns]: return meta
+        return meta if meta["digest"] == fileDigest(source) else None
+
+    def _load(self, tag):
+        if self._meta(tag):
+            with np.load(self._file(tag)) as saved:
+                shape = tuple(saved["shape"])
+                return np.unpackbits(saved["bits"], count=shape[0]*shape[1]).reshape(shape).astype(bool)
+
+        source = os.path.join(self.path, self.sources[tag])
+        stat   = os.stat(source)
+        mask   = traceReference(toNP(self.path, self.sources[tag]), self.minpixel).astype(bool)
+        bits   = np.packbits(mask)
+        meta   = {"source": self.sources[tag], "minpixel": self.minpixel, "size": stat.st_size,
+                  "mtime": stat.st_mtime_ns, "digest": fileDigest(source),
+                  "mask": _digest(bits.tobytes() + str(mask.shape).encode())}
+        tmp    = self._file(tag) + ".tmp.npz"
+        np.savez(tmp, bits=bits, shape=np.asarray(mask.shape), meta=np.asarray(json.dumps(meta)))
+        os.replace(tmp, self._file(tag))
+        return mask
+
+
+@instrument("createSplices")
+def createSplices(path, im, mode='square', dim=64, k=None, stride=None):
     """returns list of splices according to which to partition the image to.
 
     :param path: directory where the images are.
     :param im: numpy array of the image.
-    :param mode: the type of partition algorithm used, with 'square' as default, and 'variable' as an option.
-                 'Square' partitions the image into dim by dim partitions provided the input dim evenly
-                 divides the image dimensions. 'Variable'
+    :param mode: the type of partition algorithm used, with 'square' as default, and 'variable' and 'adaptive'
+                 as options. 'Square' partitions the image into dim by dim partitions provided the input dim
+                 evenly divides the image dimensions. 'Variable' (or 'feature', its original name) partitions
+                 along the k strongest vertical edges of the image. 'Adaptive' splices every image by its own
+                 edges, as 'variable' does for this one, when it is partitioned (im is then not used).
+                 'Sliding' partitions the image into overlapping dim by dim windows every stride pixels.
     :param dim: integer value specifying the dimension value used for partitioning.
-    :returns: a method call that performs the specified partition algorithm in the mode parameter.
+    :param k: integer number of edges used by the 'variable' and 'adaptive' modes.
+    :param stride: integer number of pixels between 'sliding' windows, with default of None for dim // 2.
+    :returns: a method call that performs the specified partition algorithm in the mode parameter, or for
+              'adaptive' an AdaptiveSplices that part() calls per image.
 
     NOTE  can add new modes for splicing in the future easily here together with a method to perform the
           partition.
     """
-    if mode == 'square' and len(toNP(path, im))%dim!=0:
-        raise AttributeError("'dim' of %d does not evenly divide image dimension %d by %d" % (xdim, len(npim), len(npim[0])))
+    if mode not in ['square', 'variable', 'feature', 'adaptive', 'sliding']:
+        raise AttributeError("'mode' must be 'square', 'variable', 'feature', 'adaptive' or 'sliding', not %r" % mode)
+    if mode == 'adaptive':
+        return AdaptiveSplices(dim, k)
+    npim = toNP(path, im)  # decoded once here and served from imcache to the splice method below
+    if mode == 'square' and (len(npim)%dim!=0 or len(npim[0])%dim!=0):
+        raise AttributeError("'dim' of %d does not evenly divide image dimension %d by %d" % (dim, len(npim), len(npim[0])))
+    if mode == 'sliding' and (dim > len(npim) or dim > len(npim[0])):
+        raise AttributeError("'dim' of %d is larger than image dimension %d by %d" % (dim, len(npim), len(npim[0])))
     if mode == 'square':
         return squareSplice(path, im, dim)
-    if mode == 'variable':
+    if mode in ['variable', 'feature']:
         return variableSplice(path, im, dim, k)
+    if mode == 'sliding':
+        return slidingSplice(path, im, dim, stride if stride else max(dim // 2, 1))
+
+
+class AdaptiveSplices:
+    """splices computed per image from the image's own edges (see variableSplice), for images whose features
+    do not line up with a single reference image. part() calls it with each image it partitions.
+
+    :param dim: integer value specifying the row dimension value used for partitioning.
+    :param k: integer number of edges to identify in each image.
+
+    NOTE  each image costs its edge profile, which part() computes from the image it decodes anyway (or
+          partBands() from its bands), and edgeSplices() on it, which is a small fraction of that (about 0.5 ms
+          of 30 ms per Apples scan). images with fewer than 2 edges are spliced into dim by dim squares
+          instead, with a warning, and counted in fallbacks.
+    """
+
+    def __init__(self, dim, k):
+        self.dim, self.k = dim, k
+        self.fallbacks   = 0
+        self._last       = (None, None)
+
+    def __call__(self, path, im, profile=None):
+        """return list of splices for the image im at path.
+
+        :param profile: 3-tuple, with default of None, of the image's shape and its edgeProfile() (e.g., from
+                        bandProfile()), so that the image is not decoded whole to compute them.
+        """
+        # part() asks twice per image (to score, then to crop), so the last image's splices are kept at hand
+        stamp = (os.path.join(path, im), os.stat(os.path.join(path, im)).st_mtime_ns)
+        if self._last[0] == stamp: return self._last[1]
+
+        if profile is None:
+            npim = toNP(path, im)
+            profile = (npim.shape, *edgeProfile(npim))
+        shape, _, diffs = profile
+        try:
+            splices = edgeSplices(diffs, shape[0], self.dim, self.k)
+        except ValueError as e:  # too few edges, so one scan does not abort the whole run
+            warnings.warn("%s: %s; splicing it into %d by %d squares instead" % (im, e, self.dim, self.dim))
+            self.fallbacks += 1
+            splices = [[(r, r+self.dim), (c, c+self.dim)]  # as squareSplice() does
+                       for r in range(0, shape[0], self.dim) for c in range(0, shape[1], self.dim)]
+        self._last = (stamp, splices)
+        return splices
+
+
+def imSplices(path, im, splices):
+    """return the list of splices for the image im, calling splices with the image if it is an AdaptiveSplices.
+    """
+    return splices(path, im) if callable(splices) else splices
 
 
 def squareSplice(path, im, dim):
@@ -157,7 +604,32 @@ def squareSplice(path, im, dim):
     npim = toNP(path, im)
     return [[(r, r+dim),(c, c+dim)]
             for r in range(0, len(npim), dim)
-            for c in range(0, len(npim), dim)]
+            for c in range(0, len(npim[0]), dim)]
+
+
+def slidingSplice(path, im, dim, stride):
+    """return list of overlapping dim by dim splices for the image, starting every stride pixels along each axis
+    (and once more flush with the last row and column, so that the whole image is covered).
+
+    :param path: directory where the images are.
+    :param im: numpy array of the image.
+    :param dim: integer value specifying the dimension value used for partitioning.
+    :param stride: integer number of pixels between the starts of neighbouring windows; less than dim overlaps.
+    :returns: splices of the same form as squareSplice(), every one of which is a window of windowView().
+    """
+    npim = toNP(path, im)
+    rows = np.unique(np.r_[np.arange(0, len(npim) - dim + 1, stride), len(npim) - dim]).tolist()
+    cols = np.unique(np.r_[np.arange(0, len(npim[0]) - dim + 1, stride), len(npim[0]) - dim]).tolist()
+    return [[(r, r+dim),(c, c+dim)] for r in rows for c in cols]
+
+
+def windowView(npim, rows, cols):
+    """return read only view (no copy) of every rows by cols window of the RGB channels of npim, with shape
+    (height - rows + 1, width - cols + 1, rows, cols, 3), so that windowView(npim, rows, cols)[r0, c0] is
+    npim[r0:r0+rows, c0:c0+cols, :3]. indexing it with arrays of r0 and c0 copies just those windows at once.
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(npim[:, :, :3], (rows, cols), axis=(0, 1))
+    return windows.transpose(0, 1, 3, 4, 2)
 
 def variableSplice(path, im, dim, k):
     """return list of 2-tuples with indices of partitions of image, where image is a numpy array,
@@ -171,70 +643,104 @@ def variableSplice(path, im, dim, k):
     :returns: splices that can be iterated over to generate partitions; these splices have the form of a list
               lists with tuples where the tuples contain the row and column splices for the partition.
     """
-    # build kMaxDiffs to store the k largest differences between successive column sums of pixel values
+    npim = toNP(path, im)
+    return edgeSplices(edgeProfile(npim)[1], len(npim), dim, k)
+
+
+def edgeSplices(diffs, rows, dim, k):
+    """return splices as variableSplice() does, given the edgeProfile() differences of an image with rows rows.
+    """
+    if not k or k < 2: raise AttributeError("'k' of %s is too small; variable splicing needs at least 2 edges" % k)
+
     # assumptions:
-    # - large differences in column pixel sums represent edges (such as the outlines of cargo containers)
+    # - large differences in mean bright pixel value between successive columns represent edges (such as
+    #   the outlines of cargo containers)
     # - no vertical feature occurs more often than every 5 pixels and the cargo is at least 5 pixels wide
     #   giving us a featureWidth of 5
-    # algorithm: get sum of pixel values for each column. then get difference between column
-    # i and i-1. the greatest differences represent the greatest changes from dark to light,
-    # or from no feature to some feature in the image.
-    featureWidth = 5
-    batchSize    = 64
-    npim         = toNP(path, im)
-    npim         = npim[:,:,:3].sum(axis=2)  # drop alpha channel and sum RGB channels
-
-    colValues = []
-    for col in range(len(npim[0])):
-        rsum, count = 0, 0
-        for i in range(len(npim[:][col])):
-            pixel = npim[i][col]
-            if pixel > 30:
-                count += 1
-                rsum += pixel
-        if count != 0:
-            colValues.append(rsum/count)
-        else:
-            colValues.append(0)
-
-    batchDiffs, maxDiffs, kMaxDiffs = [], [], []
-    for i in range(1, len(colValues)):
-        diff = abs((colValues[i] - colValues[i-1]))
-        if len(kMaxDiffs) < k: kMaxDiffs.append((i, diff))  # 2-tuples as (index, difference)
-        batchDiffs.append((i, diff))
-
-        # algorithm: get max of last 5 col differences (i.e., batch 5 pixel sums using our feature width)
-        if i%featureWidth==0:
-            maxBatchDiff = sorted(batchDiffs, key=lambda tup : tup[1], reverse=True)[0]
-            maxDiffs.append(maxBatchDiff)
-            batchDiffs = []
-
-        # for each batch, grab the largest difference and append to k max diffs.
-        # if its larger than any, replacing the smallest. this per batch process also ensures
-        # an O(n) sort rather than O(nlogn) sort.
-        if i%batchSize==0:
-            maxDiff = sorted(maxDiffs, key=lambda tup : tup[1], reverse=True)[0][1]
-            if any(list(map(
-                    lambda x : x[1] < maxDiff,
-                    kMaxDiffs))):
-                diffOnly                   = [x[1] for x in kMaxDiffs]
-                minLargest                 = min(diffOnly)
-                minLargestIndex            = list(diffOnly).index(minLargest)
-                kMaxDiffs[minLargestIndex] = (i, maxDiff)
-            maxDiffs = []
+    edges      = topEdges(diffs, k, featureWidth=5)
+    if len(edges) < 2:  # e.g. a blank scan, whose profile has no peaks
+        raise ValueError("only %d vertical edge(s) found; variable splicing needs at least 2" % len(edges))
 
     # assumption: hinges in door are equidistant so we can set the new x to be the
     # dfference between the first two values
     # algorithm: create k+1 windows of new x dimension by old y dimension (the
-    # parameter dim) using kLargestDiffs, which is a list of 2-tuples of form
-    # (index, difference) with the k largest differences in the image.
-    kMaxDiffs.sort(key=lambda x : x[0])  # sort by index
-    print(kMaxDiffs)
-    xdim       = int(kMaxDiffs[1][0] - kMaxDiffs[0][0])  # set uniform x dimension
-    startIndex = kMaxDiffs[0][0]  # grab first index
+    # parameter dim) using the k largest edges, sorted by index. windows that would start past the last
+    # column of the image are dropped
+    xdim       = int(edges[1] - edges[0])  # set uniform x dimension
+    startIndex = int(edges[0])  # grab first index
     return [[(r, r+dim),(c, c+xdim)]
-            for c in range(startIndex, xdim*(k), xdim)
-            for r in range(0, len(npim), dim)]
+            for c in range(startIndex, min(xdim*(k), len(diffs)), xdim)
+            for r in range(0, rows, dim)]
+
+
+def edgeProfile(npim, brightpixel=30):
+    """returns 2-tuple of numpy arrays as (column means, differences) describing the vertical edges in an image.
+
+    :param npim: numpy array of the image.
+    :param brightpixel: integer value, with default of 30, that specifies the summed RGB value a pixel must
+                        exceed to count towards its column's mean.
+    :returns: the mean summed RGB value of the bright pixels in each column (0 for columns without any) and
+              the absolute difference between each column's mean and the previous column's (0 for column 0).
+    """
+    return _edgeMeans(*_edgeSums(npim, brightpixel))
+
+
+def _edgeSums(npim, brightpixel=30):
+    """return 2-tuple of the summed RGB values of the bright pixels in each column and how many there are.
+    """
+    summed  = npim[:, :, 0].astype(np.uint16)  # drop alpha channel and sum RGB channels
+    summed += npim[:, :, 1]
+    summed += npim[:, :, 2]
+    bright  = summed > brightpixel
+    count   = np.count_nonzero(bright, axis=0)
+    summed[~bright] = 0
+    return summed.sum(axis=0, dtype=np.int64), count
+
+
+def _edgeMeans(sums, count):
+    means   = np.divide(sums, count, out=np.zeros(len(count)), where=count!=0)
+    diffs   = np.zeros(len(means))
+    diffs[1:] = np.abs(np.diff(means))
+    return means, diffs
+
+
+def bandProfile(filepath, rows=64, brightpixel=30):
+    """returns 3-tuple of (image shape, column means, differences) as edgeProfile() computes them, reading the
+    png at filepath rows rows at a time with PngRows rather than decoding it whole. raises ValueError for pngs
+    PngRows cannot read.
+    """
+    with PngRows(filepath) as reader:
+        sums, count = np.zeros(reader.shape[1], dtype=np.int64), np.zeros(reader.shape[1], dtype=np.int64)
+        while reader.row < reader.shape[0]:
+            bandsums, bandcount = _edgeSums(reader.read(rows), brightpixel)
+            sums += bandsums
+            count += bandcount
+        return (reader.shape, *_edgeMeans(sums, count))
+
+
+def topEdges(diffs, k, featureWidth=5):
+    """returns sorted numpy array of the column indices of the k strongest edges in an edgeProfile() difference
+    profile, at most one per featureWidth window.
+
+    :param diffs: numpy array of column differences from edgeProfile().
+    :param k: integer number of edges to return (fewer if the profile has fewer peaks).
+    :param featureWidth: integer value, with default of 5, that specifies the narrowest feature; kept edges are at
+                         least featureWidth columns apart (non-maximum suppression).
+    """
+    # algorithm: a column is a peak if it holds the largest difference within featureWidth-1 columns either
+    # side. peaks that tie with an earlier peak that close are the same edge and are dropped. the k largest
+    # peaks are then selected in O(n) with argpartition rather than sorting.
+    radius = featureWidth - 1
+    padded = np.pad(diffs, radius, constant_values=-np.inf)
+    peaks  = (diffs == np.lib.stride_tricks.sliding_window_view(padded, 2*radius + 1).max(axis=1)) & (diffs > 0)
+    if radius:
+        before  = np.concatenate(([0], np.cumsum(peaks)))  # before[i] is the number of peaks in columns < i
+        columns = np.arange(len(diffs))
+        peaks  &= (before[columns] - before[np.maximum(columns - radius, 0)]) == 0
+    candidates = np.flatnonzero(peaks)
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-diffs[candidates], k-1)[:k]]
+    return np.sort(candidates)
 
 
 def checkPart(im, rsplice, csplice, bthresh, bminpixel):
@@ -248,17 +754,15 @@ def checkPart(im, rsplice, csplice, bthresh, bminpixel):
     :returns:
     :rtype:
     """
-    xdim = rsplice[1] - rsplice[0]
-    ydim = csplice[1] - csplice[0]
     part = im[rsplice[0]:rsplice[1], csplice[0]:csplice[1]][:, :, :3]
+    area = part.shape[0] * part.shape[1]  # the part of the splice inside the image
+    if not area: return False
 
     # bratio is the ratio of pixels where the RGB value is greater than the inputted min pixel
     # value for black, giving is a measure of how "black" a pixel
     # this then returns whether the ratio is under the threshold, which if it is, means the
     # part is not too black to include in training
-    bratio = sum([0 if np.all(part[r][c] > bminpixel) else 1  # check if each pixel is greater than min
-                    for r in range(xdim)
-                    for c in range(ydim)]) / (xdim * ydim)
+    bratio = np.count_nonzero(~np.all(part > bminpixel, axis=2)) / area  # check if each pixel is greater than min
     return bratio < bthresh
 
 
@@ -272,39 +776,1266 @@ def labelPart(imname, im, ref, rsplice, csplice, athresh):
     :returns:
     :rtype:
     """
-    xdim = csplice[1] - csplice[0]
-    ydim = rsplice[1] - rsplice[0]
     part = im[rsplice[0]:rsplice[1], csplice[0]:csplice[1]][:, :, :3]
+    refs = ref[rsplice[0]:rsplice[1], csplice[0]:csplice[1]]
 
     # aratio is the sum of pixel values in the reference for this splice divided by
     # the total number of pixels, giving us how much of the splice is anomalous
     # ref[r][c] is 1 pixel in the part generated from the inputted row and col splice
-    aratio = sum([0 if ref[r][c] == 0 else 1
-                    for r in range(rsplice[0], rsplice[1])
-                    for c in range(csplice[0], csplice[1])]) / (xdim * ydim)
+    aratio = np.count_nonzero(refs) / refs.size if refs.size else 0.0
     return (imname, part, 1) if aratio > athresh else (imname, part, 0)
 
 
-def saveParts(partedIms, anompath, noanompath):
+def scoreSplices(im, ref, splices, bminpixel=5):
+    """returns 2-tuple of numpy arrays as (bratio, aratio) holding, for every splice, the ratio of black pixels
+    that checkPart() thresholds and the ratio of anomalous pixels that labelPart() thresholds.
+
+    :param im: numpy array of the image.
+    :param ref: reference array for the image's anomaly tag generated by buildReference(), or None to skip
+                the anomaly ratios (which are then returned as None).
+    :param splices: list of splices of the form [[(rowindex1, rowindex2), (colindex1, colindex2)], ...]
+    :param bminpixel: integer value, with default of 5, that specifies the ceiling value for what constitutes
+                      a black pixel.
+    :returns: 2-tuple of float numpy arrays, each with one ratio per splice.
+    """
+    # algorithm: build a summed-area table (integral image) of the "is black" and "is anomalous" masks once,
+    # after which the count of either inside any splice is 4 lookups, so scoring every splice is O(pixels +
+    # splices) rather than O(pixels * splices). ratios are taken over the part of each splice inside the image;
+    # splices entirely outside it score a bratio of 1, so they are always rejected.
+    bounds = clipBounds(np.asarray(splices, dtype=np.int64).reshape(-1, 4), im.shape)  # rows of (r0, r1, c0, c1)
+    area   = (bounds[:, 1] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 2])
+    inside = area > 0
+    black  = ~np.all(im[:, :, :3] > bminpixel, axis=2)
+    bratio = np.divide(spliceSums(integralImage(black), bounds), area, out=np.ones(len(area)), where=inside)
+    aratio = None if ref is None else np.divide(spliceSums(integralImage(ref != 0), bounds), area,
+                                                out=np.zeros(len(area)), where=inside)
+    return bratio, aratio
+
+
+def integralImage(mask):
+    """returns summed-area table of a 2D array, padded with a leading row and column of 0s so that
+    table[r, c] is the sum of mask[:r, :c].
+    """
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    np.cumsum(mask, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def clipBounds(bounds, shape):
+    """returns array of splice bounds with rows of (r0, r1, c0, c1) clipped to an image of shape, so that r1 - r0
+    and c1 - c0 are the rows and columns of each splice inside the image (0 for splices outside it).
+    """
+    return np.concatenate([np.clip(bounds[:, :2], 0, shape[0]), np.clip(bounds[:, 2:], 0, shape[1])], axis=1)
+
+
+def spliceSums(table, bounds):
+    """returns sum of the masked array inside each splice given its integralImage() table and an array of
+    splice bounds with rows of (r0, r1, c0, c1). bounds are clipped to the image.
+    """
+    r0, r1 = np.clip(bounds[:, 0], 0, len(table)-1), np.clip(bounds[:, 1], 0, len(table)-1)
+    c0, c1 = np.clip(bounds[:, 2], 0, len(table[0])-1), np.clip(bounds[:, 3], 0, len(table[0])-1)
+    return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+
+@instrument("saveParts")
+def saveParts(partedIms, anompath, noanompath, workers=4, compress_level=6):
     """saves partitioned images to disk in up to 2 different locations for anomalous
        versus non-anomalous images.
 
-    :param:
-    :param:
-    :param:
-    :param:
-    :returns:
-    :rtype:
+    :param partedIms: list of lists of (image name, numpy array, label) tuples generated by imPartition().
+    :param anompath: directory for partitions labeled 1.
+    :param noanompath: directory for partitions labeled 0.
+    :param workers: integer value, with default of 4, that specifies how many threads encode and write pngs.
+    :param compress_level: integer value between 0 (uncompressed, fastest) and 9, with default of 6, that
+                           specifies the png compression level.
+    :returns: dictionary of write report per directory as returned by PngWriter.close().
+    """
+    return streamParts((p for p in partedIms if p), anompath, noanompath, workers, compress_level)
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Streaming pipeline                                #
+#                                                   #
+#                                                   #
+#####################################################
+
+def iterIms(path):
+    """yields names of the pngs at path one at a time, as getIms() lists them but without building a dataframe.
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name[-3:]=='png': yield entry.name
+
+
+def iterPartition(path, images, reference, splices, blackthresh=0.80, bminpixel=5, anomthresh=0.10,
+                  failures=None, banded=False):
+    """yields the partitions of each image as soon as it is partitioned, i.e., a streaming imPartition().
+
+    :param images: iterable of image names, such as iterIms(path) or a dataframe column like ims[0].
+    :param failures: list, with default of None, that (if given) collects (image name, exception) 2-tuples for
+                     images that could not be partitioned. those images are skipped with a warning.
+    :returns: generator of lists of tuples as (path, numpy array, label of 0 or 1), one list per image that
+              is partitioned. images part() skips (no tag or anomaly only views) are not yielded.
+
+    NOTE  other parameters described in imPartition.
+    """
+    # only the current image is in flight: its partitions are views of the decoded array, which is released
+    # (or left to imcache's budget) once the consumer moves on to the next image
+    for im in images:
+        try:
+            parts = (partBands if banded else part)(path, im, reference, splices, blackthresh, bminpixel, anomthresh)
+        except Exception as e:
+            if failures is not None: failures.append((im, e))
+            warnings.warn("skipping %s: %r" % (im, e))
+            continue
+        if parts is not None: yield parts
+
+
+def streamParts(partedIms, anompath, noanompath, workers=4, compress_level=6):
+    """saves the partitions from iterPartition() to disk as they arrive, in up to 2 different locations for
+    anomalous versus non-anomalous images, and returns the write report per directory from PngWriter.close().
+
+    NOTE  files are named by image name and the index of the partition's splice, so a rerun with the same
+          splices overwrites a partition's png (even if thresholds change which partitions are kept) rather than
+          duplicating it. pngs of partitions no longer kept are left; see dropParts(). other parameters
+          described in saveParts.
+    """
+    with PngWriter(workers, compress_level) as writer:
+        for parts in partedIms:
+            writeParts(parts, anompath, noanompath, writer)
+    return writer.report
+
+
+def writeParts(parts, anompath, noanompath, writer):
+    """queue one image's partitions, as returned by part(), on a PngWriter as streamParts() names them.
+
+    NOTE  partitions that are plain tuples rather than Part()s are numbered by position in parts instead.
+    """
+    for j, (imname, imarray, imlabel) in enumerate(parts):
+        impath = anompath if imlabel==1 else noanompath
+        splice = getattr(parts[j], "splice", None)
+        writer.write(imarray, os.path.join(impath, imname[:-4] + "_" + str(j if splice is None else splice) + ".png"))
+
+
+def dropParts(names, *directories):
+    """delete the pngs writeParts() wrote for the images in names from every directory in directories, together
+    with their entries in the directory's manifest.json, and return how many pngs were deleted.
+    """
+    stems   = {name[:-4] for name in names}
+    deleted = 0
+    for directory in directories:
+        if not os.path.isdir(directory): continue
+        manifest = os.path.join(directory, MANIFEST)
+        entries  = {}
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                entries = json.load(f)["files"]
+        # writeParts() names pngs <image name without .png>_<number>.png
+        ours = lambda filename : (filename[-4:] == ".png" and filename[:-4].rpartition("_")[0] in stems and
+                                  filename[:-4].rpartition("_")[2].isdigit())
+        for filename in [filename for filename in os.listdir(directory) if ours(filename)]:
+            os.remove(os.path.join(directory, filename))
+            deleted += 1
+        if any(ours(filename) for filename in entries):
+            with open(manifest + ".tmp", "w") as f:
+                json.dump({"files": {filename : size for filename, size in entries.items() if not ours(filename)}}, f)
+            os.replace(manifest + ".tmp", manifest)
+    return deleted
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Band decoding                                     #
+#                                                   #
+#                                                   #
+#####################################################
+
+PNGSIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNGCHANNELS  = {2: 3, 6: 4}  # png color type -> channels, for the 8 bit RGB and RGBA pngs PngRows reads
+
+
+class PngRows:
+    """reads a png a few rows at a time, so that only those rows (and not the whole image) are ever decoded in
+    memory. use as a context manager or call close().
+
+    :param filepath: path to an 8 bit, non interlaced RGB or RGBA png; anything else raises ValueError.
+
+    NOTE  memory use is bounded by the rows read at once (and the zlib window), not the size of the image.
+    """
+
+    def __init__(self, filepath):
+        self._file = open(filepath, "rb")
+        try:
+            length, kind = self._header() if self._file.read(8) == PNGSIGNATURE else (0, b"")
+            if kind != b"IHDR": raise ValueError("%s is not a png" % filepath)
+            width, height, depth, color, _, _, interlace = struct.unpack(">IIBBBBB", self._file.read(length))
+            if depth != 8 or color not in PNGCHANNELS or interlace:
+                raise ValueError("%s is not an 8 bit, non interlaced RGB or RGBA png" % filepath)
+        except BaseException:
+            self._file.close()
+            raise
+        self._file.read(4)  # crc
+        self.shape   = (height, width, PNGCHANNELS[color])
+        self.row     = 0    # index of the next row read() returns
+        self._zlib   = zlib.decompressobj()
+        self._left   = 0    # bytes of the current IDAT chunk not yet read
+        self._idat   = None # whether the IDAT chunks have started (True) or ended (False)
+        self._prev   = np.zeros(width * self.shape[2], dtype=np.uint8)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def _header(self):
+        length, kind = struct.unpack(">I4s", self._file.read(8))
+        return length, kind
+
+    def _compressed(self, size=1 << 16):
+        """return up to size bytes of the image's zlib stream, or b"" once it has all been read.
+        """
+        while not self._left:
+            if self._idat is False: return b""
+            if self._idat: self._file.read(4)  # crc of the previous IDAT chunk
+            length, kind = self._header()
+            if kind == b"IDAT":
+                self._idat, self._left = True, length
+            elif self._idat or kind == b"IEND":
+                self._idat = False
+            else:
+                self._file.seek(length + 4, os.SEEK_CUR)  # an ancillary chunk before the image data
+        data        = self._file.read(min(size, self._left))
+        self._left -= len(data)
+        return data
+
+    def read(self, n):
+        """return uint8 numpy array of shape (rows, width, channels) with the next n rows of the image, or fewer
+        at its end.
+        """
+        n      = min(n, self.shape[0] - self.row)
+        stride = self.shape[1] * self.shape[2]
+        need   = n * (stride + 1)  # every row is prefixed by its filter type
+        raw    = bytearray()
+        while len(raw) < need:
+            data = self._zlib.unconsumed_tail or self._compressed()
+            if not data: raise ValueError("png ended after %d of %d rows" % (self.row, self.shape[0]))
+            raw += self._zlib.decompress(data, need - len(raw))
+        # the rows are unfiltered by Pillow's png (zip) decoder, fed as an uncompressed zlib stream that starts
+        # with the previous decoded row (filter type 0), which the first row's up, average and paeth filters use
+        block = np.empty((n + 1, stride + 1), dtype=np.uint8)
+        block[0, 0], block[0, 1:], block[1:] = 0, self._prev, np.frombuffer(raw, dtype=np.uint8).reshape(n, stride + 1)
+        mode  = "RGBA" if self.shape[2] == 4 else "RGB"
+        rows  = np.asarray(Image.frombytes(mode, (self.shape[1], n + 1), zlib.compress(block.tobytes(), 0), "zip",
+                                           mode))[1:]
+        if n: self._prev = rows[-1].ravel()
+        self.row += n
+        return rows
+
+
+@instrument("part")
+def partBands(path, im, ref, splices, bthresh=0.8, minbpixel=5, athresh=0.1):
+    """returns the same partitions as part(), decoding the image band by band with PngRows so that at most the
+    rows of the tallest splice (plus the overlap of the next) are decoded at once, rather than the whole image.
+
+    NOTE  partitions are copies rather than views of the decoded image. an AdaptiveSplices gets the image's edge
+          profile from a first band by band pass, so the image is read twice. images PngRows cannot read are
+          decoded whole, as part() does. parameters described in imPartition.
+    """
+    tag = getTag(im)
+    if not tag or "anomaly_only_view" in im:
+        if metrics is not None: metrics.count(skipped=1)
+        return
+    try:
+        # adaptive splices come from the image's edge profile, which is read band by band in a first pass
+        imsplices = (splices(path, im, bandProfile(os.path.join(path, im))) if isinstance(splices, AdaptiveSplices)
+                     else imSplices(path, im, splices))
+        reader    = PngRows(os.path.join(path, im))
+    except ValueError:
+        return part(path, im, ref, splices, bthresh, minbpixel, athresh)
+    bounds  = np.asarray(imsplices, dtype=np.int64).reshape(-1, 4)  # rows of (r0, r1, c0, c1)
+
+    # algorithm: splices are visited grouped by their row span, in order of first row. rows are read into a
+    # buffer until the span's last row and dropped once no later span starts before them. each span is scored
+    # as scoreSplices() scores the whole image, with bounds relative to the span's first row.
+    kept = []
+    with reader:
+        height = reader.shape[0]
+        buffer = np.empty((0, *reader.shape[1:]), dtype=np.uint8)
+        top    = 0  # image row of buffer[0]
+        for r0, r1 in np.unique(bounds[:, :2], axis=0).tolist():
+            if r0 >= height: continue
+            if min(r1, height) > top + len(buffer):
+                buffer = np.concatenate([buffer, reader.read(min(r1, height) - top - len(buffer))])
+            buffer, top = buffer[r0 - top:], r0
+            band    = buffer[:min(r1, height) - r0]
+            span    = np.flatnonzero((bounds[:, 0] == r0) & (bounds[:, 1] == r1))
+            local   = bounds[span] - [r0, r0, 0, 0]
+            bratio, aratio = scoreSplices(band, ref[tag][r0:r1], local, minbpixel)
+            kept += [(i, band[:, c0:c1][:, :, :3].copy(), 1 if a > athresh else 0)
+                     for i, (c0, c1), b, a in zip(span.tolist(), bounds[span, 2:].tolist(), bratio, aratio)
+                     if b < bthresh]
+    kept.sort(key=lambda k : k[0])  # in splice order, as part() returns them
+    if metrics is not None:
+        anomalous = sum(label for _, _, label in kept)
+        metrics.count(images=1, kept=len(kept), rejected=len(bounds) - len(kept), anomalous=anomalous,
+                      nonanomalous=len(kept) - anomalous)
+    return [Part(im, array, label, i) for i, array, label in kept]
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Png writer                                        #
+#                                                   #
+#                                                   #
+#####################################################
+
+class PngWriter:
+    """writes numpy arrays as pngs on a pool of threads (Pillow releases the GIL while encoding).
+
+    :param workers: integer value, with default of 4, that specifies how many threads encode and write pngs.
+    :param compress_level: integer value between 0 (uncompressed, fastest) and 9, with default of 6, that
+                           specifies the png compression level.
+
+    NOTE  every png is written to a temporary file and renamed into place, so readers never see a partial
+          file. on close() each directory gets a manifest.json of the pngs written to it (merged with earlier
+          runs) and report holds files, bytes, seconds and throughput per directory.
+    """
+
+    def __init__(self, workers=4, compress_level=6):
+        self.compress_level = compress_level
+        self.report   = {}
+        self._pool    = ThreadPoolExecutor(max_workers=workers)
+        self._slots   = threading.BoundedSemaphore(4 * workers)  # bounds arrays waiting to be written
+        self._lock    = threading.Lock()
+        self._written = {}  # directory -> {file name : bytes}
+        self._futures = []
+        self._start   = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, array, name):
+        """queue array to be written as a png to the file path name.
+        """
+        self._slots.acquire()
+        self._futures.append(self._pool.submit(self._write, array, name))
+
+    def _write(self, array, name):
+        try:
+            directory, filename = os.path.split(name)
+            tmp = os.path.join(directory, ".%s.%d.tmp" % (filename, threading.get_ident()))
+            try:
+                Image.fromarray(array).save(tmp, format="PNG", compress_level=self.compress_level)
+                os.replace(tmp, name)
+            except BaseException:
+                if os.path.exists(tmp): os.remove(tmp)
+                raise
+            with self._lock:
+                self._written.setdefault(directory, {})[filename] = os.path.getsize(name)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """wait for every queued png, write the manifests and return the report.
+        """
+        self._pool.shutdown(wait=True)
+        for future in self._futures: future.result()  # raise the first write error, if any
+        self._futures = []
+        seconds = time.perf_counter() - self._start
+        for directory, written in self._written.items():
+            manifest = os.path.join(directory, MANIFEST)
+            entries  = {}
+            if os.path.exists(manifest):
+                with open(manifest) as f:
+                    entries = json.load(f)["files"]
+            entries.update(written)
+            with open(manifest + ".tmp", "w") as f:
+                json.dump({"files": entries}, f)
+            os.replace(manifest + ".tmp", manifest)
+
+            nbytes = sum(written.values())
+            self.report[directory] = {"files": len(written), "bytes": nbytes, "seconds": seconds,
+                                      "files_per_s": len(written) / seconds, "mb_per_s": nbytes / seconds / 2**20}
+            if metrics is not None: metrics.count(pngs=len(written), png_bytes=nbytes)
+        return self.report
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Partition datasets                                #
+#                                                   #
+#                                                   #
+#####################################################
+
+# a partition dataset is a directory with a manifest.json and, for every partition shape (geometry), a
+# contiguous uint8 .npy array of the partitions together with .npy side arrays of their labels and of the
+# index (into the manifest's list of source image names) of the image they were cut from
+MANIFEST   = "manifest.json"
+_NPYHEADER = 256  # bytes reserved for .npy headers so that the shape can be rewritten in place on append
+
+
+class PartitionWriter:
+    """appends partitions to a partition dataset directory, creating it if needed.
+
+    :param directory: path to the dataset directory.
+
+    NOTE  use as a context manager or call close(); flush() makes everything written so far loadable. build is
+          a dictionary saved with the manifest for callers to record how the dataset was built.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.names, self.geometries, self.build = [], {}, {}
+        if os.path.exists(os.path.join(directory, MANIFEST)):
+            with open(os.path.join(directory, MANIFEST)) as f:
+                manifest = json.load(f)
+            self.names      = manifest["sources"]
+            self.geometries = manifest["geometries"]
+            self.build      = manifest.get("build", {})
+        self._index   = {name : i for i, name in enumerate(self.names)}
+        self._files   = {}
+        self._labels  = {g : list(np.load(self._path(meta["labels"]))) for g, meta in self.geometries.items()}
+        self._sources = {g : list(np.load(self._path(meta["sources"]))) for g, meta in self.geometries.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _file(self, geometry, shape):
+        if geometry not in self._files:
+            if geometry not in self.geometries:
+                self.geometries[geometry] = {"shape": list(shape), "count": 0, "data": geometry + ".npy",
+                                             "labels": geometry + "_labels.npy",
+                                             "sources": geometry + "_sources.npy"}
+                self._labels[geometry], self._sources[geometry] = [], []
+                with open(self._path(self.geometries[geometry]["data"]), "wb") as f:
+                    f.write(_npyHeader((0, *shape)))
+            # drop any bytes appended after the last flush (e.g., by a run that crashed) before appending
+            meta = self.geometries[geometry]
+            self._files[geometry] = open(self._path(meta["data"]), "r+b")
+            self._files[geometry].truncate(_NPYHEADER + meta["count"] * int(np.prod(meta["shape"])))
+            self._files[geometry].seek(0, os.SEEK_END)
+        return self._files[geometry]
+
+    def append(self, imname, array, label):
+        """append one partition cut from the image named imname with its label.
+        """
+        array    = np.ascontiguousarray(array, dtype=np.uint8)
+        geometry = "x".join(str(d) for d in array.shape)
+        if imname not in self._index:
+            self._index[imname] = len(self.names)
+            self.names.append(imname)
+        self._file(geometry, array.shape).write(array.tobytes())
+        self._labels[geometry].append(label)
+        self._sources[geometry].append(self._index[imname])
+        self.geometries[geometry]["count"] += 1
+
+    def extend(self, parts):
+        """append every (image name, numpy array, label) tuple of parts, such as the output of part().
+        """
+        for imname, array, label in parts:
+            self.append(imname, array, label)
+
+    def drop(self, names, chunk=1024):
+        """remove every partition cut from the images in names, compacting the arrays in place.
+
+        NOTE  rows are moved forward chunk partitions at a time, so only rows after the first dropped one are
+              rewritten and memory use is bounded by chunk.
+        """
+        dropped = [self._index[name] for name in names if name in self._index]
+        for geometry, meta in self.geometries.items():
+            keep = ~np.isin(np.asarray(self._sources[geometry], dtype=np.int64), dropped)
+            if keep.all(): continue
+            f, rowbytes, w = self._file(geometry, meta["shape"]), int(np.prod(meta["shape"])), 0
+            for start in range(0, meta["count"], chunk):
+                rows = np.flatnonzero(keep[start:start+chunk])
+                n    = min(chunk, meta["count"] - start)
+                if w == start and len(rows) == n:  # nothing dropped yet, so these rows are already in place
+                    w += n
+                    continue
+                f.seek(_NPYHEADER + start * rowbytes)
+                block = np.frombuffer(f.read(n * rowbytes), dtype=np.uint8).reshape(n, rowbytes)
+                f.seek(_NPYHEADER + w * rowbytes)
+                f.write(block[rows].tobytes())
+                w += len(rows)
+            f.truncate(_NPYHEADER + w * rowbytes)
+            f.seek(0, os.SEEK_END)
+            meta["count"]           = w
+            self._labels[geometry]  = list(np.asarray(self._labels[geometry])[keep])
+            self._sources[geometry] = list(np.asarray(self._sources[geometry])[keep])
+
+    def flush(self):
+        """rewrite the array headers, side arrays and manifest so the dataset holds everything appended so far.
+        """
+        for geometry, f in self._files.items():
+            meta = self.geometries[geometry]
+            f.flush()
+            f.seek(0)
+            f.write(_npyHeader((meta["count"], *meta["shape"])))
+            f.seek(0, os.SEEK_END)
+        for geometry, meta in self.geometries.items():
+            np.save(self._path(meta["labels"]), np.asarray(self._labels[geometry], dtype=np.int8))
+            np.save(self._path(meta["sources"]), np.asarray(self._sources[geometry], dtype=np.int64))
+        tmp = self._path(MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "sources": self.names, "geometries": self.geometries, "build": self.build}, f)
+        os.replace(tmp, self._path(MANIFEST))
+
+    def close(self):
+        """flush and close the dataset.
+        """
+        self.flush()
+        for f in self._files.values(): f.close()
+        self._files = {}
+
+
+def _npyHeader(shape):
+    """return .npy version 1.0 header for a C ordered uint8 array of shape, padded to _NPYHEADER bytes.
+    """
+    header = "{'descr': '|u1', 'fortran_order': False, 'shape': %r, }" % (tuple(shape),)
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", _NPYHEADER - 10) + header.ljust(_NPYHEADER - 11).encode("latin1") + b"\n"
+
+
+def loadPartitions(directory, mmap_mode="r"):
+    """returns 2-tuple of (list of source image names, dictionary of geometry to 3-tuples of (partitions, labels,
+    source indices)) for a partition dataset written by PartitionWriter.
+
+    :param directory: path to the dataset directory.
+    :param mmap_mode: memory map mode passed to np.load for the partitions, with default of 'r' so that they
+                      can be sliced without reading or copying the whole array. None loads them into memory.
+    """
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    return manifest["sources"], {geometry : (np.load(os.path.join(directory, meta["data"]), mmap_mode=mmap_mode),
+                                             np.load(os.path.join(directory, meta["labels"])),
+                                             np.load(os.path.join(directory, meta["sources"])))
+                                 for geometry, meta in manifest["geometries"].items()}
+
+
+def convertNpy(npyfiles, directory, source="unknown"):
+    """convert .npy object arrays of (numpy array, label) tuples, as __main__ used to save partitions, to a
+    partition dataset at directory. their source images were not saved, so all are attributed to source.
+    """
+    with PartitionWriter(directory) as writer:
+        for npyfile in npyfiles:
+            for array, label in np.load(npyfile, allow_pickle=True):
+                writer.append(source, array, int(label))
+
+
+@instrument("featureMatrix")
+def buildFeatureMatrix(parts, out=None, chunk=4096, dtype=np.float32, index=None):
+    """returns matrix with one row per partition holding its flattened pixels divided by their L2 norm.
+
+    :param parts: numpy array (or memmap, e.g. from loadPartitions() or gatherParts()) of partitions with shape
+                  (n, rows, cols, channels), or a sequence of n partition arrays of the same shape.
+    :param out: path to a .npy file or numpy array, with default of None, to write the matrix to instead of a new
+                array in memory. a path is opened as a memmap so matrices larger than memory can be built.
+    :param chunk: integer value, with default of 4096, that specifies how many partitions are converted at once,
+                  which bounds the temporary memory used.
+    :param dtype: numpy float type of the matrix, with default of float32.
+    :param index: array of row indices, with default of None, of the partitions to use (e.g., from
+                  balanceIndices()), which are gathered a chunk at a time rather than copied up front.
+    :returns: numpy array (or memmap) of shape (n, rows * cols * channels).
+
+    NOTE  rows that are all 0 are left as 0s rather than divided by a norm of 0.
+    """
+    n        = len(parts) if index is None else len(index)
+    features = int(np.prod(np.shape(parts[0]))) if len(parts) else 0
+    if isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=(n, features))
+    X = np.empty((n, features), dtype=dtype) if out is None else out
+
+    # algorithm: each chunk is cast straight into its rows of X, then normalized in place with row norms from
+    # einsum, so no float64 or per partition copies are made
+    for start in range(0, n, chunk):
+        stop  = min(start + chunk, n)
+        take  = range(start, stop) if index is None else index[start:stop]
+        if isinstance(parts, np.ndarray):
+            block = parts[start:stop] if index is None else parts[take]
+        else:
+            block = np.stack([parts[i] for i in take])
+        rows  = X[start:stop]
+        rows[...] = block.reshape(stop - start, features)
+        norms = np.sqrt(np.einsum("ij,ij->i", rows, rows))
+        norms[norms == 0] = 1
+        rows /= norms[:, None]
+    if isinstance(X, np.memmap): X.flush()
+    return X
+
+
+@instrument("updatePartitions")
+def updatePartitions(path, ims, reference, splices, directory, blackthresh=0.80, bminpixel=5, anomthresh=0.10,
+                     onparts=None, banded=False, ondrop=None, failures=None, workers=1, chunksize=1):
+    """partition only the images in ims that are new or changed since the partition dataset at directory was
+    last built, drop the partitions of images that changed or are no longer in ims, and return a dictionary of
+    how many images were added, changed, removed, unchanged and failed.
+
+    :param directory: path to the partition dataset, which is created if it does not exist.
+    :param onparts: function, with default of None, that is called with the partitions of every image that
+                    is (re)partitioned, e.g. to also write them as pngs.
+    :param ondrop: function, with default of None, that is called with the names of the images whose partitions
+                   are dropped, before any are rewritten, e.g. to delete their pngs with dropParts().
+    :param failures: list, with default of None, that (if given) collects (image name, exception) 2-tuples for
+                     images that could not be partitioned. those images are skipped with a warning and left
+                     out of the dataset, so the next update tries them again.
+    :param workers: integer value, with default of 1, that specifies how many processes partition the added
+                    images, as in imPartition(). None uses every core. partitions are still added to the dataset
+                    (and passed to onparts) one image at a time, in order, by this process.
+
+    NOTE  an image is rebuilt whenever its build key changes. the key hashes the image's content, its tag's
+          reference mask, the splices and the thresholds. content hashes are reused while a file's size and
+          modification time are unchanged, so an unchanged corpus is not reread. other parameters described
+          in imPartition.
+    """
+    settings = {"splices": ["adaptive", splices.dim, splices.k] if callable(splices) else splices,
+                "blackthresh": blackthresh, "bminpixel": bminpixel, "anomthresh": anomthresh}
+    params   = _digest(json.dumps(settings).encode())
+    refkeys  = {}  # tag -> digest of its reference, as ReferenceStore.digest() computes it
+
+    with PartitionWriter(directory) as writer:
+        keys  = writer.build.setdefault("keys", {})   # image name -> build key of its partitions in the dataset
+        stats = writer.build.setdefault("stats", {})  # image name -> [size, modification time, content hash]
+        wanted = {}
+        for im in ims[0]:
+            tag = getTag(im)
+            if not tag or "anomaly_only_view" in im: continue
+            stat = os.stat(os.path.join(path, im))
+            if stats.get(im, [None, None])[:2] != [stat.st_size, stat.st_mtime_ns]:
+                stats[im] = [stat.st_size, stat.st_mtime_ns, fileDigest(os.path.join(path, im))]
+            if tag not in refkeys:
+                refkeys[tag] = (reference.digest(tag) if isinstance(reference, ReferenceStore) else
+                                _digest(np.packbits(reference[tag] != 0).tobytes() + str(reference[tag].shape).encode()))
+            wanted[im] = _digest((stats[im][2] + refkeys[tag] + params).encode())
+
+        # orphans are sources without a build key, e.g. converted by convertNpy() or cut by an interrupted update
+        stale   = [name for name in keys if keys[name] != wanted.get(name)]
+        orphans = [name for name in writer.names if name not in keys]
+        writer.drop(stale + orphans)
+        if ondrop: ondrop(stale + orphans)
+        for name in stale: del keys[name]
+        for name in [name for name in stats if name not in wanted]: del stats[name]
+
+        added  = [im for im in wanted if im not in keys]
+        failed = []
+
+        def skip(im, e):  # e.g. a corrupt png, which is left without a key and retried next update
+            failed.append(im)
+            if failures is not None: failures.append((im, e))
+            warnings.warn("skipping %s: %r" % (im, e))
+
+        def partAdded():
+            if workers != 1:
+                yield from _partShared(path, added, reference, splices, blackthresh, bminpixel, anomthresh, workers,
+                                       chunksize, banded, onerror=skip)
+                return
+            for im in added:
+                try:
+                    yield im, (partBands if banded else part)(path, im, reference, splices, blackthresh, bminpixel,
+                                                              anomthresh)
+                except Exception as e:
+                    skip(im, e)
+
+        for i, (im, parts) in enumerate(partAdded()):
+            writer.extend(parts)
+            keys[im] = wanted[im]
+            if onparts: onparts(parts)
+            if i % 100 == 99: writer.flush()  # so an interrupted update keeps what it has done
+    added = [im for im in added if im not in failed]
+    return {"added": len([im for im in added if im not in stale]), "changed": len([im for im in added if im in stale]),
+            "removed": len([name for name in stale if name not in wanted]),
+            "unchanged": len(wanted) - len(added) - len(failed), "failed": len(failed)}
+
+
+def fileDigest(filepath):
+    """return hex digest of the contents of the file at filepath.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Parallel workers                                  #
+#                                                   #
+#                                                   #
+#####################################################
+
+# arguments shared by every task of a worker process, set once per process by _initWorker() so that
+# references and splices are not pickled with every task
+_workerargs = ()
+
+
+def _initWorker(args):
+    global _workerargs
+    _workerargs = args
+    # a worker only needs the image it is working on cached (part() asks for it up to three times), not a full
+    # budget per process, which would grow the pool's memory with the number of workers
+    if imcache is not None: configureCache(imcache.maxbytes, imcache.rgbonly, maxentries=1)
+
+
+def _pool(workers, args):
+    """return process pool of workers processes whose tasks can read args from _workerargs.
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(args,))
+
+
+def _partIndexWorker(im):
+    """return partIndex() of im with the timers and counters it recorded, if the parent records metrics.
+    """
+    global metrics
+    path, reference, splices, bthresh, minbpixel, athresh, measure = _workerargs
+    metrics = Metrics() if measure else None  # per task, merged into the parent's by _partIndices()
+    index   = partIndex(path, im, reference, splices, bthresh, minbpixel, athresh)
+    return (index, metrics.timers, metrics.counters) if measure else (index, {}, {})
+
+
+def _partWorker(ims):
+    """return list with, for every image in ims, a 5-tuple of (list of (splice index, label, shape) of the
+    partitions part() (or partBands()) keeps, or its None or [], path of a file with their pixels one after
+    another or None, timers, counters, exception raised by the image or None).
+    """
+    global metrics
+    path, reference, splices, bthresh, minbpixel, athresh, measure, banded, blocks = _workerargs
+    results = []
+    for im in ims:
+        metrics = Metrics() if measure else None  # per image, merged into the parent's by _partShared()
+        try:
+            parts = (partBands if banded else part)(path, im, reference, splices, bthresh, minbpixel, athresh)
+        except Exception as e:
+            results.append((None, None, *((metrics.timers, metrics.counters) if measure else ({}, {})), e))
+            continue
+        timers, counters = (metrics.timers, metrics.counters) if measure else ({}, {})
+        if not parts:
+            results.append((parts, None, timers, counters, None))
+            continue
+        block = os.path.join(blocks, im + ".parts")
+        with open(block, "wb") as f:
+            for p in parts: np.ascontiguousarray(p[1]).tofile(f)
+        results.append(([(p.splice, p[2], p[1].shape) for p in parts], block, timers, counters, None))
+    return results
+
+
+def _traceWorker(im):
+    path, minpixel = _workerargs
+    mask = traceReference(toNP(path, im), minpixel)
+    return np.packbits(mask.astype(bool)), mask.shape
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Training                                          #
+#                                                   #
+#                                                   #
+#####################################################
+
+@instrument("train")
+def trainLinear(X, y, method='linearsvc', seed=42, **kwargs):
+    """return a linear classifier fitted to X and y, which trains far faster than svm.SVC(kernel='linear')
+    on many high dimensional partitions.
+
+    :param method: either 'linearsvc' (default; liblinear) or 'sgd' (stochastic gradient descent on the hinge
+                   loss, for datasets too large for liblinear).
+    :param seed: integer random state, with default of 42.
+    :param kwargs: passed to LinearSVC or SGDClassifier.
+    """
+    from sklearn.svm import LinearSVC
+    from sklearn.linear_model import SGDClassifier
+    if method == 'linearsvc': return LinearSVC(random_state=seed, **kwargs).fit(X, y)
+    if method == 'sgd':       return SGDClassifier(loss='hinge', random_state=seed, **kwargs).fit(X, y)
+    raise AttributeError("'method' must be 'linearsvc' or 'sgd', not %r" % method)
+
+
+def svmGrid(C=[0.1,1,100,1000], gamma=[1,0.1,0.01], degree=[4,5,6], prefix=""):
+    """return conditional svm.SVC search space as a list of grids, so that degree is only searched for the
+    poly kernel and gamma not for the linear kernel, where they have no effect.
+
+    :param prefix: string prepended to every parameter name, e.g. 'svc__' for a step of a Pipeline.
+    """
+    grids = [{'kernel': ['rbf'],    'C': C, 'gamma': gamma},
+             {'kernel': ['poly'],   'C': C, 'gamma': gamma, 'degree': degree},
+             {'kernel': ['linear'], 'C': C}]
+    return [{prefix + name : values for name, values in grid.items()} for grid in grids]
+
+
+@instrument("train")
+def searchSVM(X, y, grid=None, halving=True, workers=-1, reduce=None, components=256, cv=3, seed=42):
+    """return fitted hyperparameter search over svm.SVC, optionally after reducing the dimension of X.
+
+    :param grid: list of grids, with default of svmGrid(), whose parameter names are those of svm.SVC.
+    :param halving: boolean, with default of True, that specifies whether to use successive halving (candidates
+                    are scored on a growing number of samples and only the best go on), rather than fitting every
+                    candidate on every sample as GridSearchCV does.
+    :param workers: integer value, with default of -1 (every core), that specifies how many jobs fit candidates.
+    :param reduce: either None (default), 'pca' or 'random' (sparse random projection), for a dimension reduction
+                   step fitted before the svm.
+    :param components: integer value, with default of 256, that specifies the reduced dimension.
+    :param cv: integer number of cross validation folds, with default of 3.
+    :returns: fitted search whose best_estimator_ is a Pipeline; see searchReport() for timings.
+    """
+    from sklearn import svm
+    from sklearn.pipeline import Pipeline
+    from sklearn.decomposition import PCA
+    from sklearn.random_projection import SparseRandomProjection
+    from sklearn.model_selection import GridSearchCV
+
+    steps = []
+    if reduce == 'pca':    steps.append(('reduce', PCA(components, svd_solver='randomized', random_state=seed)))
+    if reduce == 'random': steps.append(('reduce', SparseRandomProjection(components, random_state=seed)))
+    if reduce not in [None, 'pca', 'random']: raise AttributeError("'reduce' must be None, 'pca' or 'random'")
+    steps.append(('svc', svm.SVC()))
+    grid = [{'svc__' + name : values for name, values in g.items()} for g in (grid if grid else svmGrid())]
+
+    if halving:
+        from sklearn.experimental import enable_halving_search_cv  # noqa: F401, enables the import below
+        from sklearn.model_selection import HalvingGridSearchCV
+        # each training fold of the first round needs at least as many samples as reduced dimensions
+        minimum = min(len(X), components * cv // (cv - 1) + cv) if reduce else 'smallest'
+        search  = HalvingGridSearchCV(Pipeline(steps), grid, cv=cv, n_jobs=workers, min_resources=minimum,
+                                      random_state=seed, refit=True)
+    else:
+        search = GridSearchCV(Pipeline(steps), grid, cv=cv, n_jobs=workers, refit=True)
+    return search.fit(X, y)
+
+
+def searchReport(search):
+    """return dataframe with one row per configuration a searchSVM() search fitted, best first: its parameters,
+    mean cross validation score and mean fit and score time in seconds (and, for successive halving, the round
+    and number of samples).
     """
-    for i in range(len(partedIms)):
-        for j in range(len(partedIms[i])):
-            imname  = partedIms[i][j][0][:-4]
-            imarray = partedIms[i][j][1]
-            imlabel = partedIms[i][j][2]
-            im      = Image.fromarray(imarray)
-            impath  = anompath if imlabel==1 else noanompath
-            name    = os.path.join(impath, imname + str(i) + "_" + str(j) + ".png")
-            im.save(name)
+    import pandas as pd
+    results = search.cv_results_
+    columns = ['rank_test_score', 'mean_test_score', 'mean_fit_time', 'mean_score_time', 'iter', 'n_resources']
+    report  = pd.DataFrame({column : results[column] for column in columns if column in results})
+    report.insert(0, 'params', [{name.split('__')[-1] : value for name, value in params.items()}
+                                for params in results['params']])
+    # successive halving ranks within each round, so the last round's candidates come first
+    return report.sort_values((['iter'] if 'iter' in report else []) + ['rank_test_score'],
+                              ascending=([False] if 'iter' in report else []) + [True])
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Inference                                         #
+#                                                   #
+#                                                   #
+#####################################################
+
+MODELFILE  = "model.pkl"
+CONFIGFILE = "model.json"
+
+
+def saveModel(model, directory, splices, geometry, blackthresh=0.80, bminpixel=5):
+    """saves a fitted classifier (anything with decision_function, e.g. from trainLinear() or searchSVM()) with the
+    splice config it was trained on, so that Scorer can partition new scans the same way.
+
+    :param splices: list of splices the training partitions were cut with, as from createSplices().
+    :param geometry: shape (rows, cols, channels) of the training partitions, e.g. a key of loadPartitions().
+
+    NOTE  other parameters described in imPartition.
+    """
+    import pickle
+    os.makedirs(directory, exist_ok=True)
+    config = {"splices": np.asarray(splices, dtype=np.int64).reshape(-1, 2, 2).tolist(),
+              "geometry": [int(n) for n in geometry], "blackthresh": blackthresh, "bminpixel": bminpixel}
+    for name, write, mode in [(MODELFILE, lambda f : pickle.dump(model, f), "wb"),
+                              (CONFIGFILE, lambda f : json.dump(config, f), "w")]:
+        with open(os.path.join(directory, name + ".tmp"), mode) as f:
+            write(f)
+        os.replace(os.path.join(directory, name + ".tmp"), os.path.join(directory, name))
+
+
+class Scorer:
+    """scores new scans with a model saved by saveModel(), which is loaded once.
+
+    :param directory: directory saveModel() wrote to.
+
+    NOTE  the partitions of every scan passed to score() at once are classified in one decision_function call.
+          report holds scans, partitions, seconds, throughput and p50/p99 latency over every scan scored, where
+          a scan's latency runs from when it starts decoding to when its batch is scored.
+    """
+
+    def __init__(self, directory):
+        import pickle
+        with open(os.path.join(directory, MODELFILE), "rb") as f:
+            self.model = pickle.load(f)
+        with open(os.path.join(directory, CONFIGFILE)) as f:
+            config = json.load(f)
+        self.splices     = [tuple(map(tuple, splice)) for splice in config["splices"]]
+        self.geometry    = tuple(config["geometry"])
+        self.blackthresh = config["blackthresh"]
+        self.bminpixel   = config["bminpixel"]
+        self._latencies  = []
+        self._parts      = 0
+        self._seconds    = 0.0
+
+    def partition(self, npim):
+        """returns 2-tuple of (indices into splices, uint8 numpy array of their partitions) for the partitions
+        of npim the model scores: those that are not too black and whose splice has the model's geometry.
+        """
+        bounds  = np.asarray(self.splices, dtype=np.int64).reshape(-1, 4)
+        bratio  = scoreSplices(npim, None, self.splices, self.bminpixel)[0]
+        fits    = (bounds[:, 1] - bounds[:, 0] == self.geometry[0]) & (bounds[:, 3] - bounds[:, 2] == self.geometry[1])
+        keep    = np.flatnonzero((bratio < self.blackthresh) & fits)
+        parts   = np.zeros((len(keep), *self.geometry[:2], 3), dtype=np.uint8)  # edge partitions padded with 0s
+        inside  = (bounds[keep, 1] <= npim.shape[0]) & (bounds[keep, 3] <= npim.shape[1])
+        if inside.any():
+            parts[inside] = windowView(npim, *self.geometry[:2])[bounds[keep[inside], 0], bounds[keep[inside], 2]]
+        for n in np.flatnonzero(~inside).tolist():
+            r0, r1, c0, c1 = bounds[keep[n]].tolist()
+            view = npim[r0:r1, c0:c1, :3]
+            parts[n, :view.shape[0], :view.shape[1]] = view
+        return keep, parts
+
+    @instrument("score")
+    def score(self, images, path=""):
+        """returns list with, per scan, a dict of its name, score (NaN for splices not scored) and
+        heatmap() of the decision function of every partition.
+
+        :param images: list of image names (relative to path, or absolute) and/or numpy arrays of scans.
+        :param path: string of the directory image names are relative to, with default of "".
+        """
+        starts, scans, kept, parts = [], [], [], []
+        for im in images:
+            starts.append(time.perf_counter())
+            npim = im if isinstance(im, np.ndarray) else toNP(path, im)
+            keep, ps = self.partition(npim)
+            scans.append(npim.shape[:2]), kept.append(keep), parts.append(ps)
+
+        # every scan's partitions go through one feature matrix and one decision_function call
+        parts  = np.concatenate(parts) if parts else np.zeros((0, *self.geometry[:2], 3), dtype=np.uint8)
+        values = self.model.decision_function(buildFeatureMatrix(parts)) if len(parts) else np.zeros(0)
+        stop   = time.perf_counter()
+
+        results, offset = [], 0
+        for im, shape, keep in zip(images, scans, kept):
+            scores = np.full(len(self.splices), np.nan)
+            scores[keep] = values[offset:offset + len(keep)]
+            offset += len(keep)
+            results.append({"image": None if isinstance(im, np.ndarray) else im, "scores": scores,
+                            "heatmap": heatmap(shape, self.splices, scores)})
+        self._latencies += [stop - start for start in starts]
+        self._parts     += len(parts)
+        self._seconds   += stop - starts[0] if starts else 0.0
+        return results
+
+    def scoreDirectory(self, path, batch=16):
+        """yields the results of score() for every png at path, batch scans at a time.
+        """
+        names = sorted(iterIms(path))
+        for start in range(0, len(names), batch):
+            yield from self.score(names[start:start + batch], path)
+
+    @property
+    def report(self):
+        latencies = np.array(self._latencies)
+        seconds   = self._seconds if self._seconds else float("inf")
+        return {"scans": len(latencies), "partitions": self._parts, "seconds": self._seconds,
+                "scans_per_s": len(latencies) / seconds, "partitions_per_s": self._parts / seconds,
+                "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99": float(np.percentile(latencies, 99)) if len(latencies) else None}
+
+
+def heatmap(shape, splices, scores):
+    """returns float32 numpy array of shape (rows, cols) holding, at every pixel, the highest score of the
+    splices covering it, or NaN where no scored splice does.
+    """
+    out = np.full(shape, np.nan, dtype=np.float32)
+    for (rsplice, csplice), score in zip(splices, scores):
+        if np.isnan(score): continue
+        region = out[rsplice[0]:rsplice[1], csplice[0]:csplice[1]]
+        np.fmax(region, score, out=region)
+    return out
+
+
+def serveScorer(scorer, host="127.0.0.1", port=8000):
+    """returns a local HTTP server (call serve_forever() on it) standing in for an inference service.
+
+    POST /score takes either a png body (one scan) or a json body {"images": [paths]} (scored as one batch) and
+    answers with a json list of {"image", "partitions": [[r0, r1, c0, c1, score], ...]} per scan, listing the
+    partitions that were scored. GET /report answers with scorer.report.
+    """
+    import io
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    lock = threading.Lock()  # one batch at a time through the model
+
+    class Handler(BaseHTTPRequestHandler):
+        def _answer(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/report": return self._answer(404, {"error": "unknown path %s" % self.path})
+            self._answer(200, scorer.report)
+
+        def do_POST(self):
+            if self.path != "/score": return self._answer(404, {"error": "unknown path %s" % self.path})
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                if self.headers.get("Content-Type", "") == "image/png":
+                    images = [np.array(Image.open(io.BytesIO(body)))]
+                else:
+                    images = json.loads(body)["images"]
+                with lock:
+                    results = scorer.score(images)
+            except Exception as e:
+                return self._answer(400, {"error": repr(e)})
+            self._answer(200, [{"image": result["image"],
+                                "partitions": [[*rsplice, *csplice, float(score)] for (rsplice, csplice), score
+                                               in zip(scorer.splices, result["scores"]) if not np.isnan(score)]}
+                               for result in results])
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Deduplication                                     #
+#                                                   #
+#                                                   #
+#####################################################
+
+HASHSIZE = 8  # partitions hash to HASHSIZE x HASHSIZE = 64 bits
+
+
+@instrument("hash")
+def partHashes(parts, margin=2, chunk=4096):
+    """returns uint64 array with a difference hash of every partition: the partition is averaged to grayscale
+    HASHSIZE rows by HASHSIZE+1 columns, and each bit is whether a cell is brighter than the cell to its left.
+
+    :param parts: numpy array (or memmap, e.g. from loadPartitions()) of partitions with shape (n, rows, cols,
+                  channels), or a sequence of n partition arrays of the same shape.
+    :param margin: number, with default of 2, of grey levels a cell must exceed its neighbor by to set a bit, so
+                   that noise on flat background does not flip bits.
+    :param chunk: integer value, with default of 4096, that specifies how many partitions are hashed at once.
+
+    NOTE  near identical partitions (e.g., the same cargo with gravity jitter on and off, or background repeated
+          across scans) hash to values a few bits apart; see dedupIndices().
+    """
+    hashes = np.zeros(len(parts), dtype=np.uint64)
+    if not len(parts): return hashes
+    rows, cols = np.shape(parts[0])[:2]
+    if not rows or not cols: raise AttributeError("partitions must have at least 1 row and column")
+    # partitions with fewer rows or columns than cells (e.g., thin variable splices) are upsampled by repeating
+    # pixels, so every cell averages at least one pixel
+    rrepeat    = -(-HASHSIZE // rows)
+    crepeat    = -(-(HASHSIZE + 1) // cols)
+    rows, cols = rows * rrepeat, cols * crepeat
+    rstarts    = np.linspace(0, rows, HASHSIZE, endpoint=False).astype(np.int64)
+    cstarts    = np.linspace(0, cols, HASHSIZE + 1, endpoint=False).astype(np.int64)
+    rsizes     = np.diff(np.r_[rstarts, rows])[:, None]
+    csizes     = np.diff(np.r_[cstarts, cols])
+    for start in range(0, len(parts), chunk):
+        stop  = min(start + chunk, len(parts))
+        block = parts[start:stop] if isinstance(parts, np.ndarray) else np.stack(parts[start:stop])
+        gray  = block[..., :3].sum(axis=-1, dtype=np.float32) / 3 if block.ndim == 4 else block.astype(np.float32)
+        gray  = np.repeat(np.repeat(gray, rrepeat, axis=1), crepeat, axis=2) if rrepeat * crepeat > 1 else gray
+        cells = np.add.reduceat(np.add.reduceat(gray, rstarts, axis=1), cstarts, axis=2) / (rsizes * csizes)
+        bits  = (cells[:, :, 1:] - cells[:, :, :-1]) > margin
+        hashes[start:stop] = np.packbits(bits.reshape(stop - start, -1), axis=1).view(">u8").ravel()
+    return hashes
+
+
+class HashIndex:
+    """index of 64 bit hashes that finds a stored hash within a Hamming distance of a new one without comparing
+    it against every stored hash.
+
+    :param distance: integer value, with default of 2, of the most bits two hashes can differ by and match.
+
+    NOTE  hashes are split into distance + 1 bands. two hashes within distance bits differ in at most distance
+          bands, so share at least one band exactly, and only hashes stored under one of the new hash's band
+          values are compared.
+    """
+
+    def __init__(self, distance=2):
+        if distance < 0 or distance >= 64: raise AttributeError("distance must be between 0 and 63")
+        self.distance = distance
+        self.hashes   = []
+        edges         = np.linspace(0, 64, distance + 2).astype(int)
+        self._bands   = [(int(lo), (1 << int(hi - lo)) - 1) for lo, hi in zip(edges[:-1], edges[1:])]  # (shift, mask)
+        self._buckets = [{} for _ in self._bands]
+        self._exact   = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def query(self, h):
+        """return position of a stored hash within distance bits of h, or None.
+        """
+        if h in self._exact: return self._exact[h]
+        for (shift, mask), bucket in zip(self._bands, self._buckets):
+            for i in bucket.get((h >> shift) & mask, ()):
+                if bin(self.hashes[i] ^ h).count("1") <= self.distance: return i
+        return None
+
+    def add(self, h):
+        """return position of the stored hash h matches, storing h (as position len(self) - 1) if none does.
+        """
+        h = int(h)
+        i = self.query(h)
+        if i is not None: return i
+        i = len(self.hashes)
+        self.hashes.append(h)
+        self._exact[h] = i
+        for (shift, mask), bucket in zip(self._bands, self._buckets):
+            bucket.setdefault((h >> shift) & mask, []).append(i)
+        return i
+
+
+@instrument("dedup")
+def dedupIndices(hashes, distance=2, labels=None, strata=None):
+    """returns 3-tuple of (sorted array of the row indices to keep, array of how many rows each kept row stands
+    for, dictionary of partitions, kept and duplicates per stratum) that drops every row whose hash is within
+    distance bits of an earlier kept row with the same label.
+
+    :param hashes: array of partHashes(), one per row of a partition dataset.
+    :param distance: integer value, with default of 2, of the Hamming distance under which rows are duplicates;
+                     0 only drops identical hashes.
+    :param labels: array of 0 and 1 labels, with default of None, so anomalous and nonanomalous rows are never
+                   merged.
+    :param strata: array, with default of None, of one key per row (e.g., the cargo type from sourceColumn())
+                   that counts are reported by. duplicates are found across strata.
+
+    NOTE  the counts can weight the kept rows (e.g., sample_weight) in place of the rows merged into them.
+    """
+    # algorithm: rows are visited in order and looked up in a HashIndex per label, so the whole pass is
+    # O(n * candidates per band) rather than O(n²) pairwise comparisons
+    labels  = np.zeros(len(hashes), dtype=np.int64) if labels is None else np.asarray(labels)
+    indexes = {}
+    kept    = {}                                   # label -> row of every hash stored in its index
+    merged  = np.empty(len(hashes), dtype=np.int64)  # row each row is merged into
+    for row, (h, label) in enumerate(zip(np.asarray(hashes).tolist(), labels.tolist())):
+        index = indexes.setdefault(label, HashIndex(distance))
+        rows  = kept.setdefault(label, [])
+        i     = index.add(h)
+        if i == len(rows): rows.append(row)
+        merged[row] = rows[i]
+    keep   = np.flatnonzero(merged == np.arange(len(hashes)))
+    counts = np.bincount(np.searchsorted(keep, merged), minlength=len(keep))
+
+    strata = np.full(len(hashes), "all", dtype=object) if strata is None else np.asarray(strata)
+    report = {}
+    for stratum in np.unique(strata).tolist():
+        total = int(np.count_nonzero(strata == stratum))
+        left  = int(np.count_nonzero(strata[keep] == stratum))
+        report[stratum] = {"partitions": total, "kept": left, "duplicates": total - left}
+    if metrics is not None: metrics.count(duplicates=len(hashes) - len(keep))
+    return keep, counts, report
+
+
+def dedupParts(partedIms, distance=2, margin=2):
+    """returns 2-tuple of (partitioned images, dictionary of partitions, kept and duplicates per cargo type) with
+    near duplicate partitions dropped, as dedupIndices() drops them, from the lists of imPartition().
+
+    NOTE  partedIms keeps its form, for saveParts(): one list (or None) per image, in the same order.
+    """
+    parts  = [(i, p) for i, partitions in enumerate(partedIms) for p in partitions or []]
+    cargo  = [match.group("cargo") if match else "" for match in map(NAMEPATTERN.match, (p[0] for _, p in parts))]
+    hashes = np.zeros(len(parts), dtype=np.uint64)
+    shapes = {}
+    for row, (_, p) in enumerate(parts): shapes.setdefault(p[1].shape, []).append(row)
+    for rows in shapes.values():  # variable splices differ in shape, so are hashed a shape at a time
+        hashes[rows] = partHashes([parts[row][1][1] for row in rows], margin)
+    keep, _, report = dedupIndices(hashes, distance, labels=[p[2] for _, p in parts], strata=cargo)
+
+    deduped = [None if partitions is None else [] for partitions in partedIms]
+    for row in keep.tolist():
+        deduped[parts[row][0]].append(parts[row][1])
+    return deduped, report
+
+
+#####################################################
+#                                                   #
+#                                                   #
+# Class balancing                                   #
+#                                                   #
+#                                                   #
+#####################################################
+
+def balanceIndices(labels, ratio=[4,1], oversample=False, strata=None, seed=None):
+    """return sorted array of row indices that sample labels (0 or 1) to the inputted ratio of 0s to 1s.
+
+    :param labels: array of 0 and 1 labels, such as the label side array of a partition dataset.
+    :param ratio: 2 numbers [int1, int2], with default of [4,1], describing the ratio of 0s to 1s to sample.
+    :param oversample: boolean, with default of False, that specifies whether to draw extra rows of the minority
+                       class (with replacement, so indices repeat) rather than drop rows of the majority class.
+    :param strata: array, with default of None, of one key per row (e.g., the cargo type or anomaly tag of each
+                   partition from sourceColumn()). if given, every stratum is balanced separately, and strata
+                   without both labels are left out.
+    :param seed: integer seed, with default of None, for reproducible samples.
+    :returns: numpy array of indices that can slice labels and the matching (memory mapped) partitions.
+    """
+    # algorithm: rows are grouped by (stratum, label) with one stable counting sort, then each group is sampled
+    # to its target size, so the whole sample is O(n) and never compares rows against a list of chosen ones
+    rng    = np.random.default_rng(seed)
+    labels = np.asarray(labels)
+    keys   = np.zeros(len(labels), dtype=np.int64) if strata is None else np.unique(strata, return_inverse=True)[1]
+    groups = keys.reshape(-1) * 2 + (labels != 0)
+    ngroup = 2 * (int(keys.max()) + 1) if len(keys) else 0
+    counts = np.bincount(groups, minlength=ngroup).reshape(-1, 2)
+    order  = np.argsort(groups.astype(np.int16) if ngroup < 2**15 else groups, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(counts.reshape(-1))))
+
+    # sizes of each stratum's 0s and 1s once balanced: scale to the class that limits (or, oversampling,
+    # that exceeds) the ratio
+    scale   = counts / np.asarray(ratio, dtype=float)
+    scale   = scale.max(axis=1) if oversample else scale.min(axis=1)
+    targets = np.floor(scale[:, None] * np.asarray(ratio, dtype=float) + 1e-9).astype(np.int64)
+    targets[(counts == 0).any(axis=1)] = 0
+
+    index = []
+    for group in np.flatnonzero(targets.reshape(-1)):
+        rows, target = order[starts[group]:starts[group+1]], targets.reshape(-1)[group]
+        if target <= len(rows):
+            index.append(rows if target == len(rows) else rng.choice(rows, target, replace=False))
+        else:
+            index += [rows, rng.choice(rows, target - len(rows), replace=True)]
+    return np.sort(np.concatenate(index)) if index else np.array([], dtype=np.int64)
+
+
+def sourceColumn(names, sources, ims, column):
+    """return array with, for every partition of a partition dataset, the value of column (e.g., 'cargo' or 'tag')
+    of the image it was cut from, given the dataset's source names, its source index side array and a getCatalog()
+    dataframe, for use as strata in balanceIndices().
+    """
+    values = dict(zip(ims[0], ims[column]))
+    return np.asarray([values.get(name, "") for name in names], dtype=object)[np.asarray(sources)]
 
 
 #####################################################
@@ -324,62 +2055,205 @@ def underSamp(x0, x1, ratio=[4,1]):
     NOTE  return has form [[(numpy array, 0)], [(numpy array, 1)]], which is a list
           of lists where each has size corresponding to the inputted ratio.
     """
-    whichtosubset = 0 if len(x0) > ((ratio[0] / sum(ratio)) * (len(x0) + len(x1))) else 1
-    if whichtosubset==0:
-        tosubset = x0
-        returnas = x1
-    else:
-        tosubset = x0
-        returnas = x1
-    indicescount = len(x1) * ratio[0] if whichtosubset==0 else len(x0)//ratio[0]
-    indices      = [i for i in range(len(tosubset))]
-    rindices     = random.sample(indices, indicescount)
-    return [tup
-            for i, tup in enumerate(tosubset)
-            if i in rindices], returnas
+    labels = np.concatenate((np.zeros(len(x0), dtype=np.int8), np.ones(len(x1), dtype=np.int8)))
+    index  = balanceIndices(labels, ratio)
+    return [x0[i] for i in index[index < len(x0)]], [x1[i - len(x0)] for i in index[index >= len(x0)]]
+
 
+TAGPATTERN = re.compile(r"[pP]\d{2}")
 
+
+@functools.lru_cache(maxsize=2**16)
 def getTag(im):
     """return substring of image path string that represents anomaly positions.
 
     NOTE  different image naming convention will require different tagging
     """
-    pattern = re.compile("[pP]\d{2}")
-    tag     = [split for split in im.split("_") if pattern.match(split)]
+    tag = [split for split in im.split("_") if TAGPATTERN.match(split)]
     return tag[0] if tag else ""
 
 
-def storeIms(ims, directory, tag=None):
-    """save numpy images as pngs locally.
+def storeIms(ims, directory, tag=None, workers=4, compress_level=6):
+    """save numpy images as pngs locally, returning the write report from PngWriter.close().
     """
-    for i in range(len(ims)):
-        for j in range(len(ims[i])):
-            name = directory + tag + "_" + str(i) + "_" + str(j) + ".png"
-            im   = Image.fromarray(ims[i][j])
-            im.save(name)
+    prefix = tag + "_" if tag else ""
+    with PngWriter(workers, compress_level) as writer:
+        for i in range(len(ims)):
+            for j in range(len(ims[i])):
+                writer.write(ims[i][j], os.path.join(directory, prefix + str(i) + "_" + str(j) + ".png"))
+    return writer.report
 
 
 def getIms(path):
     """return pandas dataframe with paths of pngs.
     """
+    import pandas as pd
     return pd.DataFrame([im for im in os.listdir(path) if im[-3:]=='png'])
 
 
 def getImTypes(ims):
     """get image types for use with method subset_imgs.
     """
+    if 'cargo' in ims.columns: return list(set(ims['cargo']) - {""})  # parsed by getCatalog()
     return list(set([row[0].split("_")[1] for _, row in ims.iterrows()]))
 
 
+# columns getCatalog() parses from names like absorption_Apples_Anomaly1A20Q_P01_GravityJitterOff_view_0_200_high.png
+NAMEPATTERN = re.compile(r"^[^_]+_(?P<cargo>[^_]+)_(?P<anomaly>Anomaly[^_]*)_(?P<tag>[^_]+)_GravityJitter(?P<jitter>On|Off)"
+                         r"_(?P<anomonly>anomaly_only_)?view_(?P<view>\d+)_(?P<energy>\d+)")
+CATALOGCOLUMNS = [0, 'cargo', 'anomaly', 'tag', 'jitter', 'anomonly', 'view', 'energy']
+
+
+def getCatalog(path, cachefile=None):
+    """return pandas dataframe with paths of pngs, as getIms() does, together with the columns parsed from each
+    name: cargo type, anomaly, anomaly tag (as getTag() returns it), gravity jitter ('On' or 'Off'), whether it
+    is an anomaly only view, view and energy. names that do not parse have empty columns.
+
+    :param path: path to where the images are.
+    :param cachefile: path to a json file, with default of None, that the catalog is saved to and loaded from
+                      for as long as the directory's contents (i.e., its modification time) do not change.
+
+    NOTE  the dataframe works anywhere getIms()'s does; indexIms() and anomalyViews() build lookups from it.
+    """
+    import pandas as pd
+    mtime = os.stat(path).st_mtime_ns
+    if cachefile and os.path.exists(cachefile):
+        with open(cachefile) as f:
+            cached = json.load(f)
+        if cached["mtime"] == mtime:
+            return pd.DataFrame(cached["rows"], columns=CATALOGCOLUMNS)
+
+    ims     = getIms(path)
+    names   = ims[0] if len(ims) else pd.Series([], dtype=object)
+    parsed  = names.str.extract(NAMEPATTERN).fillna("")
+    catalog = pd.DataFrame({0: names})
+    for column in CATALOGCOLUMNS[1:]: catalog[column] = parsed[column]
+    catalog['tag']      = catalog['tag'].where(catalog['tag'].str.match(TAGPATTERN), "")
+    catalog['anomonly'] = names.str.contains("anomaly_only_view", regex=False)
+
+    if cachefile:
+        with open(cachefile + ".tmp", "w") as f:
+            json.dump({"mtime": mtime, "rows": catalog.values.tolist()}, f)
+        os.replace(cachefile + ".tmp", cachefile)
+    return catalog
+
+
+def indexIms(ims, column):
+    """return dictionary of each value of column (e.g., 'tag' or 'cargo') in a getCatalog() dataframe to the
+    list of image names with that value, for O(1) lookups.
+    """
+    index = {}
+    for name, value in zip(ims[0], ims[column]):
+        index.setdefault(value, []).append(name)
+    return index
+
+
+def anomalyViews(ims):
+    """return dictionary of anomaly tag to the name of the first anomaly only view with that tag in ims, which
+    can be a getCatalog() or getIms() dataframe.
+    """
+    names = list(ims[0])
+    tags  = ims['tag'] if 'tag' in ims.columns else map(getTag, names)
+    only  = ims['anomonly'] if 'anomonly' in ims.columns else ["anomaly_only_view" in name for name in names]
+    views = {}
+    for name, tag, anomonly in zip(names, tags, only):
+        if tag and anomonly and tag not in views: views[tag] = name
+    return views
+
+
+@instrument("decode")
 def toNP(path, im):
     """return image img as numpy array.
+
+    NOTE  decoded arrays are shared through imcache (when set) and are read only; copy before editing.
+    """
+    if imcache is None: return np.array(Image.open(os.path.join(path, im)))
+    return imcache.get(os.path.join(path, im))
+
+
+class ImageCache:
+    """bounded least recently used cache of decoded images keyed by file path and modification time.
+
+    :param maxbytes: integer value, with default of 512 MiB, that specifies the memory budget for decoded
+                     arrays. least recently used arrays are evicted once the budget is exceeded.
+    :param rgbonly: boolean, with default of False, that specifies whether to keep only the RGB channels
+                    as uint8 (dropping alpha), which is all partitioning uses.
+    :param maxentries: integer value, with default of None for no limit, that specifies how many arrays are
+                       kept at most, e.g. 1 to serve the repeated toNP() calls made for one image only.
+    """
+
+    def __init__(self, maxbytes=512 * 2**20, rgbonly=False, maxentries=None):
+        self.maxbytes   = maxbytes
+        self.rgbonly    = rgbonly
+        self.maxentries = maxentries
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self._arrays   = OrderedDict()  # path -> (mtime, decoded array), least recently used first
+        self._lock     = threading.Lock()
+
+    def get(self, impath):
+        """return decoded numpy array of the image at impath, decoding it only on a miss.
+        """
+        mtime = os.stat(impath).st_mtime_ns
+        with self._lock:
+            entry = self._arrays.get(impath)
+            if entry is not None and entry[0] == mtime:
+                self.hits += 1
+                self._arrays.move_to_end(impath)
+                return entry[1]
+            self.misses += 1
+
+        npim = np.array(Image.open(impath))
+        if self.rgbonly and npim.ndim == 3:
+            npim = np.ascontiguousarray(npim[:, :, :3], dtype=np.uint8)
+        npim.flags.writeable = False
+        with self._lock:
+            stale = self._arrays.pop(impath, None)  # an older version of this file
+            if stale is not None: self.nbytes -= stale[1].nbytes
+            self._arrays[impath] = (mtime, npim)
+            self.nbytes         += npim.nbytes
+            while self._arrays and (self.nbytes > self.maxbytes or
+                                    self.maxentries is not None and len(self._arrays) > self.maxentries):
+                _, (_, evicted)  = self._arrays.popitem(last=False)
+                self.nbytes     -= evicted.nbytes
+                self.evictions  += 1
+        return npim
+
+    def clear(self):
+        """drop every cached array and reset the counters.
+        """
+        with self._lock:
+            self._arrays.clear()
+            self.nbytes = self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """return dictionary of hit, miss and eviction counts together with the cached entries and bytes.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._arrays), 'nbytes': self.nbytes, 'maxbytes': self.maxbytes,
+                'maxentries': self.maxentries}
+
+
+# shared cache used by toNP(); replace with configureCache() or set to None to decode on every call
+imcache = ImageCache()
+
+
+def configureCache(maxbytes=512 * 2**20, rgbonly=False, maxentries=None):
+    """replace the shared image cache used by toNP() and return it.
+
+    NOTE  parameters described in ImageCache.
     """
-    return np.array(Image.open(os.path.join(path, im)))
+    global imcache
+    imcache = ImageCache(maxbytes, rgbonly, maxentries)
+    return imcache
 
 
 def openIm(npim):
     """display inline numpy image img.
     """
+    from matplotlib import pyplot as plt
     plt.figure(figsize = (25,10))
     plt.imshow(npim)
 
@@ -394,6 +2268,10 @@ def subsetIms(ims, imtype, leaveout=False, types=
     NOTE  constrains types we can subset by the default value for List[str] in method definition.
     """
     if imtype not in types: raise AttributeError
+    if 'cargo' in ims.columns:  # parsed by getCatalog(), so match columns rather than searching names
+        matches = ((ims['cargo'].str.lower() == imtype.lower()) | (ims['anomaly'] == imtype) |
+                   (ims['energy'] == imtype))
+        return ims[matches != leaveout]
     return ims[ims[0].str.contains(imtype, case=False) != leaveout]
 
 
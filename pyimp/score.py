@@ -0,0 +1,70 @@
+"""score new scans with a model saved by pyimp.saveModel(), e.g.
+
+    python pyimp/score.py MODELDIR images/scan.png images/newscans/ --out heatmaps
+    python pyimp/score.py MODELDIR --serve 8000
+
+or, with the defaults of the other stages, python -m pyimp score.
+"""
+import os
+import json
+import argparse
+
+
+def arguments(parser, optional=False):
+    """add the arguments of the score command to the argparse parser, taking the model directory as --model
+    (None unless given) rather than the first argument if optional.
+    """
+    parser.add_argument("--model" if optional else "model", help="directory written by pyimp.saveModel()")
+    parser.add_argument("images", nargs="*", help="pngs and/or directories of pngs to score")
+    parser.add_argument("--batch", type=int, default=16, help="scans classified per decision_function call")
+    parser.add_argument("--out", help="directory to save each scan's heatmap to as <scan>.npy")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="serve POST /score on this port instead")
+    parser.add_argument("--host", default="127.0.0.1")
+    return parser
+
+
+def run(args, pyimp):
+    """score the images (or serve) as args, parsed with arguments(), say.
+    """
+    scorer = pyimp.Scorer(args.model)  # loaded once for every scan (or request)
+    if args.serve is not None:
+        server = pyimp.serveScorer(scorer, args.host, args.serve)
+        print("serving on http://%s:%d/score" % server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+        return
+
+    files = [image for image in args.images if not os.path.isdir(image)]
+    for start in range(0, len(files), args.batch):
+        report(scorer.score(files[start:start + args.batch]), args.out)
+    for directory in [image for image in args.images if os.path.isdir(image)]:
+        report(scorer.scoreDirectory(directory, args.batch), args.out)
+    print(json.dumps(scorer.report, indent=2))
+
+
+def report(results, out=None):
+    """print the number of partitions scored and the highest score per scan, saving heatmaps to out if given.
+    """
+    import numpy as np
+    for result in results:
+        scored = np.count_nonzero(~np.isnan(result["scores"]))
+        top    = np.nanmax(result["scores"]) if scored else float("nan")
+        print("%-80s %6d partitions  max %8.4f" % (os.path.basename(result["image"]), scored, top))
+        if out:
+            os.makedirs(out, exist_ok=True)
+            np.save(os.path.join(out, os.path.basename(result["image"])[:-4] + ".npy"), result["heatmap"])
+
+
+def main(argv=None):
+    args = arguments(argparse.ArgumentParser(description=__doc__.splitlines()[0])).parse_args(argv)
+    if __package__:
+        from . import pyimp
+    else:
+        import pyimp
+    run(args, pyimp)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 import os
+import json
+import pickle
+import numpy as np
 import pandas as pd
 import pytest
+from PIL import Image
 from pyimp import pyimp
 
 
@@ -25,6 +29,22 @@ def ref(path, df):
     return pyimp.buildReference(path, df)
 
 
+@pytest.fixture
+def synthpath(tmp_path):
+    '''return path to a directory of small synthetic scans, with an anomaly only view, for tags P01 and P02.
+    '''
+    rng  = np.random.default_rng(0)
+    name = "absorption_Apples_Anomaly1A20Q_%s_GravityJitterOn_%sview_%d_200_high.png"
+    for tag in ["P01", "P02"]:
+        anom = np.zeros((64, 64, 4), dtype=np.uint8)
+        anom[8:30, 20:40] = 200
+        Image.fromarray(anom).save(tmp_path / (name % (tag, "anomaly_only_", 0)))
+        for view in range(2):
+            full = rng.integers(0, 256, size=(64, 64, 4), dtype=np.uint8)
+            Image.fromarray(full).save(tmp_path / (name % (tag, "", view)))
+    return str(tmp_path)
+
+
 def test_getIms(path, df):
     '''test getIms() by asserting some dataframe is returned.
     '''
@@ -53,6 +73,594 @@ def test_buildreference(path, df, ref):
 	    
 
 
+def test_traceReference():
+    '''test traceReference() by asserting an anomaly far larger than the old recursion limit is traced and that
+    only pixels with every RGB channel above the black ceiling are marked.
+    '''
+    npim = np.zeros((300, 300, 4), dtype=np.uint8)
+    npim[:, :, 3]         = 255
+    npim[20:280, 20:280]  = 100
+    npim[50, 50, 1]       = 5
+    ref  = pyimp.traceReference(npim, minpixel=5)
+    assert ref.shape == (300, 300)
+    assert ref.sum() == 260*260 - 1
+    assert ref[50, 50] == 0 and ref[0, 0] == 0 and ref[20, 20] == 1
+
+
+def test_imageCache(tmp_path):
+    '''test ImageCache by asserting repeat decodes hit, rewritten files miss, and the memory budget and entry limit
+    evict.
+    '''
+    for name in ["a.png", "b.png"]:
+        Image.fromarray(np.full((8, 8, 4), 7, dtype=np.uint8)).save(tmp_path / name)
+    cache = pyimp.ImageCache(maxbytes=8*8*3, rgbonly=True)
+    npim  = cache.get(str(tmp_path / "a.png"))
+    assert npim.shape == (8, 8, 3) and npim.dtype == np.uint8 and not npim.flags.writeable
+    assert cache.get(str(tmp_path / "a.png")) is npim
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    os.utime(tmp_path / "a.png", ns=(0, 0))
+    cache.get(str(tmp_path / "a.png"))
+    assert (cache.misses, cache.stats()['entries']) == (2, 1)
+
+    cache.get(str(tmp_path / "b.png"))
+    assert cache.evictions == 1 and cache.nbytes <= cache.maxbytes
+
+    # workers keep only the image they are working on, whatever the budget
+    shared = pyimp.imcache
+    try:
+        pyimp._initWorker(None)
+        assert pyimp.imcache is not shared and pyimp.imcache.maxentries == 1
+        for name in ["a.png", "b.png", "b.png"]: pyimp.toNP(str(tmp_path), name)
+        assert pyimp.imcache.stats()["entries"] == 1 and (pyimp.imcache.hits, pyimp.imcache.evictions) == (1, 1)
+    finally:
+        pyimp.imcache = shared
+
+
+def test_imPartition_workers(synthpath):
+    '''test imPartition() by asserting a process pool returns the same partitions, in order, as the serial map, and
+    frees the shared memory they are returned in, even when a scan fails.
+    '''
+    df      = pyimp.getIms(synthpath)
+    ref     = pyimp.buildReference(synthpath, df)
+    splices = pyimp.squareSplice(synthpath, df[0][0], 16)
+
+    assert all(np.array_equal(ref[k], v) for k, v in pyimp.buildReference(synthpath, df, workers=2).items())
+    blocks   = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+    serial   = pyimp.imPartition(synthpath, df, ref, splices)
+    parallel = pyimp.imPartition(synthpath, df, ref, splices, workers=2, chunksize=2)
+    assert len(serial) == len(parallel) == 6
+    for s, p in zip(serial, parallel):
+        assert (s is None) == (p is None)
+        if s: assert all(a[0] == b[0] and a[2] == b[2] and a.splice == b.splice and np.array_equal(a[1], b[1])
+                         for a, b in zip(s, p))
+    assert (set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()) == blocks  # every block is freed
+
+    # a scan that fails to decode raises, and the partitions already handed back are still freed
+    with open(os.path.join(synthpath, df[0][2]), "wb") as f:
+        f.write(b"not a png")
+    with pytest.raises(Exception):
+        pyimp.imPartition(synthpath, df, ref, splices, workers=2)
+    assert (set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()) == blocks
+
+
+def test_scoreSplices():
+    '''test scoreSplices() by asserting its ratios threshold the same as checkPart() and labelPart() for every splice.
+    '''
+    rng     = np.random.default_rng(1)
+    npim    = rng.integers(0, 12, size=(48, 48, 4), dtype=np.uint8)
+    ref     = (rng.random((48, 48)) > 0.8).astype(float)
+    splices = [[(r, r+16), (c, c+8)] for r in range(0, 48, 16) for c in range(0, 48, 8)]
+    splices = splices + [[(40, 56), (44, 52)], [(32, 48), (44, 60)], [(48, 64), (0, 8)], [(0, 16), (48, 56)]]  # past the edge
+    bratio, aratio = pyimp.scoreSplices(npim, ref, splices, bminpixel=5)
+    for i, s in enumerate(splices):
+        for thresh in [0.5, 0.8, 0.9]:
+            assert (bratio[i] < thresh) == pyimp.checkPart(npim, s[0], s[1], thresh, 5)
+        assert (aratio[i] > 0.2) == pyimp.labelPart("im", npim, ref, s[0], s[1], 0.2)[2]
+    # ratios are over the part inside the image, and splices outside it are never kept
+    assert bratio[-4] == np.mean(~np.all(npim[40:48, 44:48, :3] > 5, axis=2)) and aratio[-3] == np.mean(ref[32:48, 44:48])
+    assert bratio[-2:].tolist() == [1, 1] and aratio[-2:].tolist() == [0, 0]
+
+
+def test_iterPartition(synthpath, tmp_path_factory):
+    '''test iterPartition() and streamParts() by asserting a corrupt scan is skipped and every other partition is written.
+    '''
+    df      = pyimp.getIms(synthpath)
+    ref     = pyimp.buildReference(synthpath, df)
+    splices = pyimp.squareSplice(synthpath, df[0][0], 16)
+    with open(os.path.join(synthpath, "absorption_Apples_Anomaly1A20Q_P01_GravityJitterOn_view_9_200_high.png"), "wb") as f:
+        f.write(b"not a png")
+
+    failures = []
+    names    = sorted(pyimp.iterIms(synthpath))
+    stream   = pyimp.iterPartition(synthpath, names, ref, splices, failures=failures)
+    outdir   = tmp_path_factory.mktemp("out")
+    with pytest.warns(UserWarning):
+        report = pyimp.streamParts(stream, str(outdir), str(outdir))
+    expected = [p for p in pyimp.imPartition(synthpath, df, ref, splices) if p]
+    assert [f[0] for f in failures] == ["absorption_Apples_Anomaly1A20Q_P01_GravityJitterOn_view_9_200_high.png"]
+    assert report[str(outdir)]["files"] == sum(len(p) for p in expected) == len(os.listdir(outdir)) - 1
+
+    # pngs are named by splice index, so a partition keeps its name whichever other partitions are kept
+    im    = expected[0][0][0]
+    index = pyimp.partIndex(synthpath, im, ref, splices)
+    assert [p.splice for p in pickle.loads(pickle.dumps(expected[0]))] == [i for i, _ in index]
+    assert all(os.path.exists(outdir / ("%s_%d.png" % (im[:-4], i))) for i, _ in index)
+
+
+def test_partitionDataset(tmp_path):
+    '''test PartitionWriter, loadPartitions() and convertNpy() by asserting appended and converted partitions load
+    back memory mapped with their labels and sources.
+    '''
+    parts = [("a.png", np.full((4, 4, 3), i, dtype=np.uint8), i % 2) for i in range(3)]
+    with pyimp.PartitionWriter(str(tmp_path / "ds")) as writer:
+        writer.extend(parts)
+    with pyimp.PartitionWriter(str(tmp_path / "ds")) as writer:
+        writer.append("b.png", np.full((2, 4, 3), 9, dtype=np.uint8), 1)
+        writer.append("b.png", np.full((4, 4, 3), 7, dtype=np.uint8), 1)
+    names, partitions = pyimp.loadPartitions(str(tmp_path / "ds"))
+    data, labels, sources = partitions["4x4x3"]
+    assert names == ["a.png", "b.png"] and isinstance(data, np.memmap)
+    assert data[:, 0, 0, 0].tolist() == [0, 1, 2, 7]
+    assert labels.tolist() == [0, 1, 0, 1] and sources.tolist() == [0, 0, 0, 1]
+    assert partitions["2x4x3"][0].shape == (1, 2, 4, 3)
+
+    old = np.empty(3, dtype=object)
+    old[:] = [(p[1], p[2]) for p in parts]
+    np.save(tmp_path / "old.npy", old, allow_pickle=True)
+    pyimp.convertNpy([str(tmp_path / "old.npy")], str(tmp_path / "converted"))
+    _, converted = pyimp.loadPartitions(str(tmp_path / "converted"))
+    assert np.array_equal(converted["4x4x3"][0], data[:3]) and converted["4x4x3"][1].tolist() == [0, 1, 0]
+
+
+def test_saveParts(tmp_path):
+    '''test saveParts() by asserting every partition is written once, by label, with a manifest and report per directory.
+    '''
+    rng   = np.random.default_rng(2)
+    parts = [[("a.png", rng.integers(0, 256, (8, 8, 3), dtype=np.uint8), j % 2) for j in range(5)],
+             None,
+             [("b.png", rng.integers(0, 256, (8, 8, 3), dtype=np.uint8), 0)]]
+    anom, noanom = tmp_path / "anom", tmp_path / "noanom"
+    anom.mkdir(), noanom.mkdir()
+    report = pyimp.saveParts(parts, str(anom), str(noanom), workers=3, compress_level=0)
+    assert sorted(os.listdir(anom)) == ["a_1.png", "a_3.png", pyimp.MANIFEST]
+    assert sorted(os.listdir(noanom)) == ["a_0.png", "a_2.png", "a_4.png", "b_0.png", pyimp.MANIFEST]
+    assert report[str(noanom)]["files"] == 4 and report[str(anom)]["bytes"] > 2 * 8 * 8 * 3
+    assert np.array_equal(np.array(Image.open(anom / "a_3.png")), parts[0][3][1])
+
+
+def test_variableSplice(tmp_path):
+    '''test edgeProfile(), topEdges() and variableSplice() by asserting the edges of vertical bands are found, at most
+    one per feature width, and used for the splice columns, which never start past the image.
+    '''
+    npim = np.zeros((32, 120, 4), dtype=np.uint8)
+    npim[:, :, 3]     = 255
+    npim[:, 20:50]    = 200
+    npim[:, 50:51]    = 150  # a weaker step just before the falling edge at 51, so it is suppressed
+    npim[:, 80:110]   = 100
+    npim[::2, 80:110] = 0    # dark rows are left out of the column means
+    means, diffs = pyimp.edgeProfile(npim)
+    assert means[0] == 0 and means[30] == 600 and means[90] == 300
+    assert pyimp.topEdges(diffs, 3).tolist() == [20, 51, 80]
+    assert pyimp.topEdges(diffs, 2).tolist() == [20, 51]
+    assert pyimp.topEdges(diffs, 10, featureWidth=1).tolist() == [20, 50, 51, 80, 110]
+
+    Image.fromarray(npim).save(tmp_path / "im.png")
+    splices = pyimp.variableSplice(str(tmp_path), "im.png", 16, 3)
+    assert splices[0] == [(0, 16), (20, 51)] and len(splices) == 6
+    splices = pyimp.variableSplice(str(tmp_path), "im.png", 16, 5)  # windows would run to column 175 of 120
+    assert sorted({c for _, (c, _) in splices}) == [20, 51, 82, 113]
+
+
+def test_slidingSplice(synthpath, tmp_path_factory):
+    '''test squareSplice(), slidingSplice() and windowView() on a non-square image by asserting tiles and overlapping
+    windows cover every column, windows are views of the image, and parts cut with them match the windows.
+    '''
+    tmp_path = tmp_path_factory.mktemp("wide")
+    npim     = np.random.default_rng(1).integers(0, 256, size=(48, 80, 4), dtype=np.uint8)
+    Image.fromarray(npim).save(tmp_path / "wide.png")
+    square = pyimp.createSplices(str(tmp_path), "wide.png", dim=16)
+    assert len(square) == 15 and square[-1] == [(32, 48), (64, 80)]
+    with pytest.raises(AttributeError):
+        pyimp.createSplices(str(tmp_path), "wide.png", dim=32)
+
+    windows = pyimp.createSplices(str(tmp_path), "wide.png", mode='sliding', dim=32, stride=12)
+    assert sorted({r for r, c in windows}) == [(0, 32), (12, 44), (16, 48)]
+    assert sorted({c for r, c in windows}) == [(0, 32), (12, 44), (24, 56), (36, 68), (48, 80)]
+    view = pyimp.windowView(npim, 32, 32)
+    assert np.shares_memory(view, npim) and np.array_equal(view[12, 36], npim[12:44, 36:68, :3])
+
+    df      = pyimp.getIms(synthpath)
+    ref     = pyimp.buildReference(synthpath, df)
+    windows = pyimp.createSplices(synthpath, df[0][0], mode='sliding', dim=16, stride=4)
+    parts   = [p for ps in pyimp.imPartition(synthpath, df, ref, windows) if ps for p in ps]
+    names, records = pyimp.partRecords(synthpath, df, ref, windows)
+    assert len(records) == len(parts) > 4 * 16
+    assert all(np.array_equal(g, p[1]) for g, p in zip(pyimp.gatherParts(synthpath, names, records), parts))
+    tiles   = [p for ps in pyimp.imPartition(synthpath, df, ref, pyimp.squareSplice(synthpath, df[0][0], 16)) if ps
+               for p in ps]
+    assert len(parts) > 4 * len(tiles) and sum(p[2] for p in parts) > 4 * sum(p[2] for p in tiles)
+
+
+def test_partBands(synthpath, tmp_path_factory):
+    '''test PngRows and partBands() by asserting rows read a few at a time are the decoded png, partitions are the
+    same as part()'s for tiles and overlapping windows, and a large scan is partitioned without decoding it whole.
+    '''
+    import tracemalloc
+    df  = pyimp.getIms(synthpath)
+    ref = pyimp.buildReference(synthpath, df)
+    for splices in [pyimp.squareSplice(synthpath, df[0][0], 16),
+                    pyimp.createSplices(synthpath, df[0][0], mode='sliding', dim=24, stride=10),
+                    [[(56, 72), (56, 72)], [(64, 80), (0, 16)], [(0, 16), (64, 80)]]]:  # past the edge
+        for im in df[0]:
+            parts, bands = pyimp.part(synthpath, im, ref, splices), pyimp.partBands(synthpath, im, ref, splices)
+            assert (parts is None) == (bands is None) and all(p[1].size for p in parts or [])
+            assert [(p[0], p[1].tolist(), p[2]) for p in parts or []] == [(b[0], b[1].tolist(), b[2]) for b in bands or []]
+        with pyimp.PngRows(os.path.join(synthpath, im)) as reader:
+            rows = [reader.read(7) for _ in range(11)]
+        assert np.array_equal(np.concatenate(rows), pyimp.toNP(synthpath, im)) and len(rows[-1]) == 0
+
+    tmp_path = tmp_path_factory.mktemp("large")
+    name     = "absorption_Apples_Anomaly1A20Q_P01_GravityJitterOn_view_0_200_high.png"
+    npim     = np.zeros((4096, 512, 3), dtype=np.uint8)
+    npim[100:200, 100:300] = np.random.default_rng(0).integers(6, 256, size=(100, 200, 3))
+    Image.fromarray(npim).save(tmp_path / name)
+    ref      = {"P01": np.zeros((4096, 512))}
+    splices  = pyimp.squareSplice(str(tmp_path), name, 32)
+    tracemalloc.start()
+    bands    = pyimp.partBands(str(tmp_path), name, ref, splices)
+    peak     = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < npim.nbytes / 4
+    parts    = pyimp.part(str(tmp_path), name, ref, splices)
+    assert [b[1].tolist() for b in bands] == [p[1].tolist() for p in parts]
+    assert [b.splice for b in bands] == [p.splice for p in parts] != list(range(len(parts)))
+    assert all(np.array_equal(p[1], npim[slice(*splices[p.splice][0]), slice(*splices[p.splice][1])]) for p in parts)
+
+    adaptive = pyimp.createSplices(None, None, mode='adaptive', dim=32, k=2)  # profiled band by band too
+    pyimp.imcache.clear()
+    tracemalloc.start()
+    bands    = pyimp.partBands(str(tmp_path), name, ref, adaptive)
+    peak     = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < npim.nbytes / 4 and pyimp.imcache.stats()["entries"] == 0
+    assert [b[1].tolist() for b in bands] == [p[1].tolist() for p in pyimp.part(str(tmp_path), name, ref, adaptive)]
+    assert all(np.array_equal(a, b) for a, b in zip(pyimp.bandProfile(str(tmp_path / name), 100)[1:],
+                                                    pyimp.edgeProfile(npim)))
+
+
+def test_createSplices_adaptive(synthpath):
+    '''test createSplices(mode='adaptive') by asserting each image is partitioned by its own variable splices and
+    that the splices of the image last asked for are kept at hand, and blank scans fall back to square splices.
+    '''
+    df       = pyimp.getIms(synthpath)
+    ref      = pyimp.buildReference(synthpath, df)
+    adaptive = pyimp.createSplices(synthpath, None, mode='adaptive', dim=16, k=3)
+    for im in df[0]:
+        expected = pyimp.part(synthpath, im, ref, pyimp.variableSplice(synthpath, im, 16, 3)) if "anomaly" not in im else None
+        parts    = pyimp.part(synthpath, im, ref, adaptive)
+        assert (parts is None) == (expected is None)
+        if parts: assert [(p[2], p[1].shape) for p in parts] == [(p[2], p[1].shape) for p in expected]
+
+    im = df[0][1]
+    assert adaptive(synthpath, im) is adaptive(synthpath, im)
+    assert adaptive(synthpath, im) == pyimp.variableSplice(synthpath, im, 16, 3)
+
+    blank = "absorption_Apples_Anomaly1A20Q_P01_GravityJitterOn_view_5_200_high.png"
+    Image.fromarray(np.zeros((64, 64, 4), dtype=np.uint8)).save(os.path.join(synthpath, blank))
+    with pytest.raises(ValueError, match="at least 2"):
+        pyimp.variableSplice(synthpath, blank, 16, 3)
+    with pytest.warns(UserWarning):
+        assert adaptive(synthpath, blank) == pyimp.squareSplice(synthpath, blank, 16) and adaptive.fallbacks == 1
+
+
+def test_createSplices_modes(synthpath):
+    '''test createSplices() by asserting 'feature' is the original name of the 'variable' mode and that unknown modes
+    raise rather than return None.
+    '''
+    im = pyimp.getIms(synthpath)[0][0]
+    assert pyimp.createSplices(synthpath, im, mode='feature', dim=16, k=3) == pyimp.variableSplice(synthpath, im, 16, 3)
+    with pytest.raises(AttributeError):
+        pyimp.createSplices(synthpath, im, mode='default')
+
+
+def test_getCatalog(synthpath, tmp_path_factory):
+    '''test getCatalog(), indexIms() and anomalyViews() by asserting names are parsed into columns, indexed, and
+    reloaded from the cache file until the directory changes.
+    '''
+    cachefile = str(tmp_path_factory.mktemp("cache") / "catalog.json")
+    catalog   = pyimp.getCatalog(synthpath, cachefile)
+    row       = catalog[catalog[0] == "absorption_Apples_Anomaly1A20Q_P02_GravityJitterOn_view_1_200_high.png"].iloc[0]
+    assert (row['cargo'], row['tag'], row['jitter'], row['view'], row['energy'], row['anomonly']) == \
+           ("Apples", "P02", "On", "1", "200", False)
+    assert pyimp.anomalyViews(catalog) == pyimp.anomalyViews(pyimp.getIms(synthpath)) == \
+           {tag : "absorption_Apples_Anomaly1A20Q_%s_GravityJitterOn_anomaly_only_view_0_200_high.png" % tag for tag in ["P01", "P02"]}
+    assert sorted(pyimp.indexIms(catalog, 'tag')["P01"]) == sorted(n for n in catalog[0] if "P01" in n)
+    assert list(pyimp.subsetIms(catalog, 'Apples')[0]) == list(catalog[0])
+
+    assert pyimp.getCatalog(synthpath, cachefile).equals(catalog)
+    tires = "absorption_Tires_Anomaly1A20Q_P03_GravityJitterOff_view_0_750_high.png"
+    Image.fromarray(np.zeros((4, 4, 4), dtype=np.uint8)).save(os.path.join(synthpath, tires))
+    assert "Tires" in pyimp.getImTypes(pyimp.getCatalog(synthpath, cachefile))
+
+
+def test_updatePartitions(synthpath, tmp_path_factory):
+    '''test updatePartitions() by asserting unchanged scans are skipped, changed and deleted scans are rebuilt and dropped
+    (with their pngs), corrupt scans are skipped and retried, and the result matches a dataset built from scratch, by one
+    process or by workers.
+    '''
+    dataset = str(tmp_path_factory.mktemp("ds") / "update")
+    pngs    = tmp_path_factory.mktemp("pngs")
+    splices = pyimp.squareSplice(synthpath, pyimp.getIms(synthpath)[0][0], 16)
+    def update(directory, **kwargs):
+        df = pyimp.getCatalog(synthpath)
+        with pyimp.PngWriter() as writer:
+            return pyimp.updatePartitions(synthpath, df, pyimp.buildReference(synthpath, df), splices, directory,
+                                          onparts=lambda p : pyimp.writeParts(p, str(pngs), str(pngs), writer),
+                                          ondrop=lambda names : pyimp.dropParts(names, str(pngs)), **kwargs)
+    def contents(directory):
+        names, partitions = pyimp.loadPartitions(directory)
+        data, labels, sources = partitions["16x16x3"]
+        return sorted((names[s], int(l), data[i].tobytes()) for i, (l, s) in enumerate(zip(labels, sources)))
+    def written():
+        with open(pngs / pyimp.MANIFEST) as f:
+            files = json.load(f)["files"]
+        assert sorted(files) == sorted(name for name in os.listdir(pngs) if name != pyimp.MANIFEST)
+        return len(files)
+
+    assert update(dataset) == {"added": 4, "changed": 0, "removed": 0, "unchanged": 0, "failed": 0}
+    assert update(dataset) == {"added": 0, "changed": 0, "removed": 0, "unchanged": 4, "failed": 0}
+    assert update(dataset, blackthresh=0.5)["changed"] == 4
+
+    name = "absorption_Apples_Anomaly1A20Q_P01_GravityJitterOn_view_%d_200_high.png"
+    os.remove(os.path.join(synthpath, name % 0))
+    Image.fromarray(np.full((64, 64, 4), 90, dtype=np.uint8)).save(os.path.join(synthpath, name % 1))
+    assert update(dataset) == {"added": 0, "changed": 3, "removed": 1, "unchanged": 0, "failed": 0}
+    assert written() == len(contents(dataset)) == 3 * 16
+    Image.fromarray(np.full((64, 64, 4), 3, dtype=np.uint8)).save(os.path.join(synthpath, name % 1))
+    assert update(dataset) == {"added": 0, "changed": 1, "removed": 0, "unchanged": 2, "failed": 0}
+    assert written() == len(contents(dataset)) == 2 * 16  # the dark scan's partitions are all rejected
+
+    with open(os.path.join(synthpath, name % 9), "wb") as f:
+        f.write(b"not a png")
+    failures = []
+    with pytest.warns(UserWarning):
+        assert update(dataset, failures=failures) == {"added": 0, "changed": 0, "removed": 0, "unchanged": 3,
+                                                      "failed": 1}
+    with pytest.warns(UserWarning):
+        assert update(dataset, workers=2, failures=failures)["failed"] == 1  # skipped by worker processes too
+    assert [f[0] for f in failures] == [name % 9, name % 9]
+    os.remove(os.path.join(synthpath, name % 9))
+
+    fresh = str(tmp_path_factory.mktemp("ds") / "fresh")
+    update(fresh)
+    assert contents(dataset) == contents(fresh)
+    parallel = str(tmp_path_factory.mktemp("ds") / "parallel")
+    assert update(parallel, workers=2)["added"] == 3
+    assert contents(parallel) == contents(fresh)
+
+
+def test_referenceStore(synthpath, tmp_path_factory):
+    '''test buildReference(store=...) by asserting references are traced once, reloaded bit packed by later runs, and
+    retraced when their source image changes.
+    '''
+    df       = pyimp.getIms(synthpath)
+    store    = str(tmp_path_factory.mktemp("refs"))
+    expected = pyimp.buildReference(synthpath, df)
+    ref      = pyimp.buildReference(synthpath, df, store=store)
+    assert isinstance(ref, pyimp.ReferenceStore) and sorted(os.listdir(store)) == []
+    assert ref["P01"].dtype == bool and np.array_equal(ref["P01"], expected["P01"])
+    assert sorted(os.listdir(store)) == ["P01.npz"]
+
+    reloaded = pyimp.buildReference(synthpath, df, store=store)
+    assert reloaded._meta("P01") and np.array_equal(reloaded["P01"], expected["P01"])
+    assert reloaded.digest("P02") == pyimp.buildReference(synthpath, df, store=store).digest("P02")
+
+    anom = np.zeros((64, 64, 4), dtype=np.uint8)
+    anom[0:4, 0:4] = 200
+    Image.fromarray(anom).save(os.path.join(synthpath, ref.sources["P01"]))
+    assert pyimp.buildReference(synthpath, df, store=store)["P01"].sum() == 16
+
+
+def test_partRecords(synthpath):
+    '''test partRecords(), partView() and gatherParts() by asserting records describe the same partitions as
+    imPartition(), views share memory with the decoded image, and gathering copies every partition.
+    '''
+    df      = pyimp.getIms(synthpath)
+    ref     = pyimp.buildReference(synthpath, df)
+    splices = pyimp.squareSplice(synthpath, df[0][0], 16)
+    parts   = [p for ps in pyimp.imPartition(synthpath, df, ref, splices) if ps for p in ps]
+    names, records = pyimp.partRecords(synthpath, df, ref, splices)
+    assert records.dtype == pyimp.PARTDTYPE and len(records) == len(parts)
+    assert [(names[r['image']], r['label']) for r in records] == [(p[0], p[2]) for p in parts]
+
+    view = pyimp.partView(synthpath, names, records[0])
+    assert np.shares_memory(view, pyimp.toNP(synthpath, names[records[0]['image']]))
+    out = np.zeros((len(records), 16, 16, 3), dtype=np.uint8)
+    assert pyimp.gatherParts(synthpath, names, records, out=out) is out
+    assert all(np.array_equal(out[i], p[1]) for i, p in enumerate(parts))
+
+    records[0]['c1'] = records[0]['c0'] + 8
+    with pytest.raises(ValueError):
+        pyimp.gatherParts(synthpath, names, records)
+
+
+def test_buildFeatureMatrix(tmp_path):
+    '''test buildFeatureMatrix() by asserting rows are the flattened, L2 normalized partitions, in chunks, in memory
+    or in a memmapped .npy file.
+    '''
+    parts = np.random.default_rng(3).integers(0, 256, size=(10, 4, 4, 3), dtype=np.uint8)
+    parts[4] = 0
+    X = pyimp.buildFeatureMatrix(parts, chunk=3)
+    expected = parts.reshape(10, -1) / np.linalg.norm(parts.reshape(10, -1).astype(float), axis=1, keepdims=True)
+    assert X.dtype == np.float32 and X.shape == (10, 48)
+    assert np.allclose(np.delete(X, 4, axis=0), np.delete(expected, 4, axis=0)) and not X[4].any()
+
+    M = pyimp.buildFeatureMatrix(list(parts), out=str(tmp_path / "X.npy"), chunk=4)
+    assert np.array_equal(np.load(tmp_path / "X.npy", mmap_mode="r"), X) and np.array_equal(M, X)
+    assert np.array_equal(pyimp.buildFeatureMatrix(parts, index=np.array([7, 1, 3]), chunk=2), X[[7, 1, 3]])
+    assert np.array_equal(pyimp.buildFeatureMatrix(list(parts), index=[7, 1]), X[[7, 1]])
+
+
+def test_balanceIndices():
+    '''test balanceIndices() and underSamp() by asserting samples have the inputted ratio, overall or per stratum, are
+    reproducible with a seed, and repeat indices only when oversampling.
+    '''
+    labels = np.array([0]*50 + [1]*5 + [0]*12 + [1]*6)
+    strata = np.array(["Apples"]*55 + ["Tires"]*18)
+    index  = pyimp.balanceIndices(labels, ratio=[4,1], seed=0)
+    assert np.array_equal(index, pyimp.balanceIndices(labels, ratio=[4,1], seed=0))
+    assert (labels[index]==1).sum() == 11 and (labels[index]==0).sum() == 44 and len(set(index)) == len(index)
+
+    index = pyimp.balanceIndices(labels, ratio=[4,1], strata=strata, seed=0)
+    assert [(labels[index][strata[index]==s]==0).sum() for s in ["Apples", "Tires"]] == [20, 12]
+    assert [(labels[index][strata[index]==s]==1).sum() for s in ["Apples", "Tires"]] == [5, 3]
+
+    index = pyimp.balanceIndices(labels, ratio=[1,1], oversample=True, seed=0)
+    assert (labels[index]==1).sum() == (labels[index]==0).sum() == 62
+
+    x0, x1 = pyimp.underSamp([(np.zeros(1), 0)]*30, [(np.ones(1), 1)]*3)
+    assert (len(x0), len(x1)) == (12, 3)
+
+
+def test_dedup():
+    '''test partHashes(), HashIndex and dedupIndices() by asserting near duplicate partitions hash a few bits apart,
+    that the index keeps the same rows as comparing every pair would, and that labels are never merged.
+    '''
+    rng   = np.random.default_rng(0)
+    parts = rng.integers(0, 256, size=(20, 32, 32, 3), dtype=np.uint8)
+    noisy = np.clip(parts.astype(int) + rng.integers(-1, 2, size=parts.shape), 0, 255).astype(np.uint8)
+    data  = np.concatenate([parts, noisy, parts // 2 + 60])  # the same partitions with noise, and dimmer
+    hashes = pyimp.partHashes(data, chunk=7)
+    assert np.array_equal(hashes, pyimp.partHashes(list(data)))
+    assert max(bin(int(a) ^ int(b)).count("1") for a, b in zip(hashes[:20], hashes[20:40])) <= 4
+    assert min(bin(int(a) ^ int(b)).count("1") for a in hashes[:20] for b in hashes[:20] if a != b) > 8
+
+    keep, counts, report = pyimp.dedupIndices(hashes, 8, strata=["Apples"]*40 + ["Tires"]*20)
+    assert keep.tolist() == list(range(20)) and counts.tolist() == [3]*20
+    assert report == {"Apples": {"partitions": 40, "kept": 20, "duplicates": 20},
+                      "Tires": {"partitions": 20, "kept": 0, "duplicates": 20}}
+    keep, counts, _ = pyimp.dedupIndices(hashes, 8, labels=[0]*40 + [1]*20)
+    assert keep.tolist() == list(range(20)) + list(range(40, 60)) and counts.sum() == 60
+
+    random = rng.integers(0, 2**63, size=300, dtype=np.uint64)
+    random = np.concatenate([random, random ^ (np.uint64(1) << rng.integers(0, 64, size=300).astype(np.uint64))])
+    kept   = []
+    for h in random.tolist():
+        if all(bin(h ^ k).count("1") > 3 for k in kept): kept.append(h)
+    assert random[pyimp.dedupIndices(random, 3)[0]].tolist() == kept and len(kept) == 300
+    name = "absorption_Apples_Anomaly1A20Q_P01_GravityJitterOn_view_0_200_high.png"
+    deduped, report = pyimp.dedupParts([None, [(name, parts[0], 0)] * 2, []])
+    assert deduped[0] is None and len(deduped[1]) == 1 and deduped[2] == [] and report["Apples"]["duplicates"] == 1
+
+    thin = rng.integers(0, 256, size=(10, 64, 5, 3), dtype=np.uint8)  # as narrow as variable splices can be
+    with np.errstate(all="raise"):
+        assert np.array_equal(pyimp.partHashes(thin), pyimp.partHashes(np.repeat(thin, 2, axis=2)))
+    assert len(pyimp.dedupIndices(pyimp.partHashes(thin), 2)[0]) == 10
+
+
+def test_searchSVM():
+    '''test trainLinear(), svmGrid() and searchSVM() by asserting degree is only searched for the poly kernel and that
+    linear and searched classifiers separate linearly separable data, with a timing row per configuration.
+    '''
+    assert [sorted(grid) for grid in pyimp.svmGrid()] == [['C','gamma','kernel'], ['C','degree','gamma','kernel'],
+                                                          ['C','kernel']]
+    rng = np.random.default_rng(0)
+    X   = rng.normal(size=(240, 40)).astype(np.float32) * np.r_[5, 5, np.ones(38)].astype(np.float32)
+    y   = (X[:, 0] + X[:, 1] > 0).astype(int)
+    for method in ['linearsvc', 'sgd']:
+        assert pyimp.trainLinear(X, y, method=method).score(X, y) > 0.9
+
+    grid   = pyimp.svmGrid(C=[1, 100], gamma=[0.01], degree=[2])
+    search = pyimp.searchSVM(X, y, grid, halving=False, workers=1, reduce='pca', components=8)
+    report = pyimp.searchReport(search)
+    assert len(report) == 6 and report['mean_fit_time'].notna().all() and search.score(X, y) > 0.9
+    assert search.best_estimator_.named_steps['reduce'].n_components == 8
+
+    search = pyimp.searchSVM(X, y, grid, halving=True, workers=1)
+    assert pyimp.searchReport(search)['iter'].iloc[0] == search.n_iterations_ - 1
+
+
+def test_Scorer(synthpath, tmp_path):
+    '''test saveModel(), Scorer and serveScorer() by asserting scans scored in one batch get the same scores as the
+    model gives their partitions one scan at a time, heatmaps cover the scored splices and the server answers.
+    '''
+    import threading, urllib.request
+    df      = pyimp.getIms(synthpath)
+    ref     = pyimp.buildReference(synthpath, df)
+    splices = pyimp.squareSplice(synthpath, df[0][0], 16)
+    names, records = pyimp.partRecords(synthpath, df, ref, splices)
+    model   = pyimp.trainLinear(pyimp.buildFeatureMatrix(pyimp.gatherParts(synthpath, names, records)),
+                                records['label'])
+    pyimp.saveModel(model, str(tmp_path / "model"), splices, (16, 16, 3))
+
+    scorer  = pyimp.Scorer(str(tmp_path / "model"))
+    scans   = [name for name in sorted(pyimp.iterIms(synthpath)) if "anomaly_only" not in name]
+    results = scorer.score(scans, synthpath)
+    for name, result in zip(scans, results):
+        keep, parts = scorer.partition(pyimp.toNP(synthpath, name))
+        assert np.allclose(result["scores"][keep], model.decision_function(pyimp.buildFeatureMatrix(parts)))
+        assert np.isnan(np.delete(result["scores"], keep)).all() and result["heatmap"].shape == (64, 64)
+        r0, r1, c0, c1 = np.asarray(splices[keep[0]]).ravel()
+        assert np.allclose(result["heatmap"][r0:r1, c0:c1], result["scores"][keep[0]])
+    assert [r["image"] for r in scorer.scoreDirectory(synthpath, batch=2)] == sorted(pyimp.iterIms(synthpath))
+    assert scorer.report["scans"] == 10 and scorer.report["p99"] >= scorer.report["p50"] > 0
+
+    server = pyimp.serveScorer(scorer, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url    = "http://%s:%d" % server.server_address[:2]
+    body   = json.dumps({"images": [os.path.join(synthpath, scans[0])]}).encode()
+    answer = json.load(urllib.request.urlopen(urllib.request.Request(url + "/score", body)))
+    assert [p[4] for p in answer[0]["partitions"]] == pytest.approx(results[0]["scores"][~np.isnan(results[0]["scores"])])
+    with open(os.path.join(synthpath, scans[0]), "rb") as f:
+        request = urllib.request.Request(url + "/score", f.read(), {"Content-Type": "image/png"})
+    assert json.load(urllib.request.urlopen(request))[0]["partitions"] == answer[0]["partitions"]
+    assert json.load(urllib.request.urlopen(url + "/report"))["scans"] == 12
+    server.shutdown(), server.server_close()
+
+
+def test_Metrics(synthpath, tmp_path):
+    '''test configureMetrics() and instrument() by asserting stages are timed and partitions counted the same with and
+    without worker processes, banded or not, profiled stages are profiled and the report is saved as json.
+    '''
+    df      = pyimp.getIms(synthpath)
+    ref     = pyimp.buildReference(synthpath, df)
+    splices = pyimp.squareSplice(synthpath, df[0][0], 16)
+    parts   = [p for ps in pyimp.imPartition(synthpath, df, ref, splices) if ps for p in ps]
+    try:
+        runs = []
+        for workers, banded in [(1, False), (2, False), (1, True), (2, True)]:
+            runs.append(pyimp.configureMetrics(profile=["part"]))
+            pyimp.imPartition(synthpath, df, ref, splices, workers=workers, banded=banded)
+            assert runs[-1].timers["part"][0] == 6 and (banded or runs[-1].timers["decode"][0] >= 4)
+        counters = [run.counters for run in runs]
+        assert all(c == counters[0] for c in counters) and counters[0]["images"] == 4 and counters[0]["skipped"] == 2
+        assert counters[0]["kept"] == len(parts) and counters[0]["kept"] + counters[0]["rejected"] == 4 * 16
+        assert counters[0]["anomalous"] == sum(p[2] for p in parts)
+
+        report = runs[0].save(str(tmp_path / "run.json"))  # profiles are only kept for stages run in process
+        assert json.load(open(tmp_path / "run.json"))["counters"] == counters[1]
+        assert report["profiles"]["part"] and os.path.exists(tmp_path / "run.part.prof")
+    finally:
+        pyimp.metrics = None
+
+
+def test_parseConfig(tmp_path):
+    '''test the command line's --config by asserting switches are set by their flag names, command line flags win and
+    unknown names are rejected.
+    '''
+    from pyimp import __main__ as cli
+    config = tmp_path / "run.json"
+    config.write_text(json.dumps({"no-pngs": True, "no_halving": True, "subtype": "Tires", "test-size": 0.2}))
+    args = cli.parse(["--config", str(config)])
+    assert (args.pngs, args.halving, args.subtype, args.test_size, args.banded) == (False, False, "Tires", 0.2, False)
+    assert cli.parse(["--config", str(config), "--subtype", "Cans", "partition"]).subtype == "Cans"
+
+    config.write_text(json.dumps({"pngs": False}))
+    with pytest.raises(SystemExit):
+        cli.parse(["--config", str(config)])
+
+
 #def test_subsetIms(df):
 #    '''test subsetIms() by asserting the items in the returned dataframe all contain the inputted substring in the path.
 #    '''